@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Author: Alexander
+Description: Benchmark of the preview computation, comparing the vectorized engine in fullstack.analytics with the
+             per-reading loop get_previews used to run. Run from the repository root:
+             python benchmarks/bench_previews.py [patients] [days]
+"""
+import datetime
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("TESTING", "TRUE")
+os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+
+from fullstack import DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS
+from fullstack.analytics import compute_preview
+
+
+def get_range_idx(ranges: list, val: float):
+    for i in range(len(ranges)):
+        if val < ranges[i]:
+            return i
+    return len(ranges)
+
+
+def loop_preview(data: list, start_time: float, ranges: list, targets: list):
+    """The preview computation as it was done in DataView.get_previews before the vectorized engine"""
+    values = [0] * 96
+    counts = [0] * 96
+    dist = [0] * (len(ranges) + 1)
+    curr_time = start_time
+    total_time = data[-1]['t'] - curr_time
+    for d in data:
+        dt = d['t'] - curr_time
+        dist[get_range_idx(ranges, d['v'])] += dt / total_time
+        curr_time = d['t']
+
+        t = datetime.datetime.fromtimestamp(d['t'])
+        idx = t.hour * 4 + t.minute // 15
+        values[idx] += d['v']
+        counts[idx] += 1
+    for i in range(96):
+        try:
+            values[i] /= counts[i]
+        except ZeroDivisionError:
+            values[i] = None
+    problems = []
+    if dist[0] > targets[0]:
+        problems.append(0)
+    if dist[0] + dist[1] > targets[1]:
+        problems.append(1)
+    if dist[2] < targets[2]:
+        problems.append(2)
+    if dist[3] + dist[4] > targets[3]:
+        problems.append(3)
+    if dist[4] > targets[4]:
+        problems.append(4)
+    return {'values': values, 'distribution': dist, 'problems': problems}
+
+
+def make_series(days: int, rng: np.random.Generator):
+    start_time = int(datetime.datetime.now().timestamp()) - days * 24 * 60 * 60
+    timestamps = start_time + 300 * np.arange(1, days * 24 * 12 + 1)
+    values = np.clip(7 + np.cumsum(rng.normal(0, 0.3, len(timestamps))), 2, 25)
+    return start_time, timestamps, values
+
+
+def main():
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 14
+    rng = np.random.default_rng(0)
+    series = [make_series(days, rng) for _ in range(patients)]
+    records = [[{'t': int(t), 'v': float(v)} for t, v in zip(ts, vs)] for _, ts, vs in series]
+
+    begin = perf_counter()
+    loop_out = [loop_preview(r, s[0], DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS) for s, r in zip(series, records)]
+    loop_time = perf_counter() - begin
+
+    begin = perf_counter()
+    vector_out = [compute_preview(ts, vs, start, DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS)
+                  for start, ts, vs in series]
+    vector_time = perf_counter() - begin
+
+    for a, b in zip(loop_out, vector_out):
+        assert a['problems'] == b['problems']
+        assert np.allclose(a['distribution'], b['distribution'])
+        assert np.allclose([np.nan if v is None else v for v in a['values']],
+                           [np.nan if v is None else v for v in b['values']], equal_nan=True)
+
+    print(f"{patients} patients, {days} days, {len(records[0])} readings each")
+    print(f"loop:       {loop_time:8.3f} s")
+    print(f"vectorized: {vector_time:8.3f} s")
+    print(f"speedup:    {loop_time / vector_time:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Author: Alexander
+Description: Micro-benchmark of the response serializers on payloads shaped like the /data/get and /data/previews
+             responses. Run from the repository root: python benchmarks/bench_serializers.py [repeat]
+"""
+import datetime
+import json
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("TESTING", "TRUE")
+os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+
+from fullstack.serializers import SERIALIZERS
+
+
+def data_payload(days: int = 14):
+    rng = np.random.default_rng(0)
+    start = int(datetime.datetime.now().timestamp()) - days * 24 * 60 * 60
+    cgm = [{'t': start + 300 * i, 'v': round(float(v), 1)} for i, v in enumerate(rng.uniform(3, 15, days * 288))]
+    meals = [{'t': start + 300 * i, 'v': float(v)} for i, v in enumerate(rng.uniform(10, 80, days * 3))]
+    return {'cgm': cgm, 'meals': meals, 'basal': cgm[::12], 'bolus': meals, 'exercise': []}
+
+
+def previews_payload(patients: int = 200):
+    rng = np.random.default_rng(0)
+    return [{'_id': ObjectId(), 'patient': ObjectId(), 'values': rng.uniform(3, 15, 96).tolist(),
+             'distribution': rng.dirichlet(np.ones(5)).tolist(), 'problems': [1, 3],
+             'timestamp': datetime.datetime.now()} for _ in range(patients)]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for name, payload in [('/data/get', data_payload()), ('/data/previews', previews_payload())]:
+        print(name)
+        reference = json.loads(SERIALIZERS['bson'](payload))
+        for serializer_name, serializer in SERIALIZERS.items():
+            assert json.loads(serializer(payload)) == reference
+            begin = perf_counter()
+            for _ in range(repeat):
+                serializer(payload)
+            print(f"  {serializer_name:8} {(perf_counter() - begin) / repeat * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
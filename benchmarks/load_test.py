@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Author: Alexander
+Description: Load test of the API hot paths. Seeds a database with synthetic patients (see synthetic_data.py),
+             then drives the endpoints through the Flask test client at a given concurrency and reports latency
+             percentiles, throughput and peak memory. Uses mongomock unless --mongo-uri is given.
+             Results are written as JSON so runs on different commits can be compared with --compare.
+             Run from the repository root: python benchmarks/load_test.py --help
+"""
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test of the API hot paths")
+    parser.add_argument('--patients', type=int, default=50, help="Number of synthetic patients")
+    parser.add_argument('--days', type=int, default=14, help="Days of data per patient")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of concurrent clients")
+    parser.add_argument('--requests', type=int, default=100, help="Requests per endpoint")
+    parser.add_argument('--logins', type=int, default=10, help="Requests to /user/login, which are slow by design")
+    parser.add_argument('--mongo-uri', help="Use this MongoDB server instead of mongomock. The database is dropped")
+    parser.add_argument('--db', default='benchmark', help="Database name")
+    parser.add_argument('--output', default='bench_output.json', help="File to write the results to")
+    parser.add_argument('--compare', help="Results file of an earlier run to compare with")
+    return parser.parse_args()
+
+
+def percentiles(latencies: list) -> dict:
+    latencies = np.array(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)), 'mean_ms': float(latencies.mean())}
+
+
+def run_endpoint(app, concurrency: int, count: int, request) -> dict:
+    """
+    Sends count requests with the given number of concurrent clients
+    :param request: Function taking a test client and an index, returning a response
+    :return: Statistics of the run
+    """
+    def timed(i):
+        client = app.test_client()
+        begin = perf_counter()
+        response = request(client, i)
+        return perf_counter() - begin, response.status_code
+
+    # Warm up caches first, so the run measures the steady state. This also keeps concurrent requests from building
+    # the same preview states at once, which mongomock can't handle
+    request(app.test_client(), 0)
+
+    begin = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(count)))
+    duration = perf_counter() - begin
+
+    stats = percentiles([latency for latency, _ in results])
+    stats['count'] = count
+    stats['errors'] = sum(1 for _, status in results if status != 200)
+    stats['throughput_rps'] = count / duration
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, path: str):
+    with open(path) as f:
+        previous = json.load(f)
+    print(f"\nCompared with {path} ({previous['meta'].get('commit')})")
+    for name, stats in results['endpoints'].items():
+        old = previous['endpoints'].get(name)
+        if old is None:
+            continue
+        changes = ", ".join(f"{key} {(stats[key] / old[key] - 1) * 100:+.1f}%" for key in ['p50_ms', 'p95_ms', 'throughput_rps']
+                            if old[key])
+        print(f"  {name:16} {changes}")
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, ROOT)
+    os.environ["MONGO_DB_NAME"] = args.db
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        os.environ.pop("TESTING", None)
+    else:
+        os.environ["TESTING"] = "TRUE"
+
+    from fullstack import app, db, mongo_client
+    import synthetic_data
+
+    print(f"Seeding {args.patients} patients with {args.days} days of data")
+    mongo_client.drop_database(args.db)
+    if args.mongo_uri:
+        # The same collections and indexes as in production
+        import setup_database
+        setup_database.setup_indexes(db)
+    else:
+        # mongomock has no time series collections
+        db.users.create_index('email', unique=True, collation={'locale': 'en', 'strength': 2})
+        db.cache.create_index('patient', unique=True)
+    users = synthetic_data.seed(db, args.patients, args.days)
+
+    client = app.test_client()
+    patient_keys = [client.post('/api/v1/user/login', json={'email': email, 'password': 'password1'}).json['api_key']
+                    for email in users['patients']]
+    doctor_key = client.post('/api/v1/user/login', json={'email': users['doctor'], 'password': 'password1'}).json['api_key']
+
+    endpoints = {
+        'login': (args.logins, lambda c, i: c.post('/api/v1/user/login', json={
+            'email': users['patients'][i % len(users['patients'])], 'password': 'password1'})),
+        'data_get': (args.requests, lambda c, i: c.post('/api/v1/data/get', json={'ndays': args.days}, headers={
+            'api_key': patient_keys[i % len(patient_keys)]})),
+        'data_previews': (args.requests, lambda c, i: c.get('/api/v1/data/previews', headers={'api_key': doctor_key})),
+        'user': (args.requests, lambda c, i: c.get('/api/v1/user/', headers={'api_key': doctor_key})),
+    }
+
+    results = {
+        'meta': {'commit': git_commit(), 'time': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+                 'database': 'mongodb' if args.mongo_uri else 'mongomock',
+                 'params': {key: value for key, value in vars(args).items() if key not in ['output', 'compare']}},
+        'endpoints': {},
+    }
+    tracemalloc.start()
+    for name, (count, request) in endpoints.items():
+        stats = run_endpoint(app, args.concurrency, count, request)
+        results['endpoints'][name] = stats
+        print(f"{name:16} p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms  "
+              f"{stats['throughput_rps']:8.1f} req/s  {stats['errors']} errors")
+    results['peak_traced_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['peak_rss_mb'] = maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+    print(f"Peak traced memory {results['peak_traced_memory_mb']:.1f} MB, peak RSS {results['peak_rss_mb']:.1f} MB")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
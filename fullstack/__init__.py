@@ -7,23 +7,41 @@ from flask_cors import CORS
 from pymongo import MongoClient
 import os
 import mongomock
+from fullstack.metrics import CommandTimer, install
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["X-Next-Cursor"])
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY") or "secret_key"
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 app.url_map.strict_slashes = False
+app.config["JSON_SERIALIZER"] = os.getenv("JSON_SERIALIZER") or "auto"
+app.config["DATA_FETCH_WORKERS"] = int(os.getenv("DATA_FETCH_WORKERS") or 8)
+app.config["PREVIEW_ENGINE"] = os.getenv("PREVIEW_ENGINE") or "aggregate"
+app.config["PRINCIPAL_CACHE_SIZE"] = int(os.getenv("PRINCIPAL_CACHE_SIZE") or 10000)
+app.config["PRINCIPAL_CACHE_TTL"] = float(os.getenv("PRINCIPAL_CACHE_TTL") or 60)
+app.config["ACCESS_TOKEN_TTL"] = int(os.getenv("ACCESS_TOKEN_TTL") or 15 * 60)
+app.config["REFRESH_TOKEN_TTL"] = int(os.getenv("REFRESH_TOKEN_TTL") or 30 * 24 * 60 * 60)
+app.config["BCRYPT_ROUNDS"] = int(os.getenv("BCRYPT_ROUNDS") or 12)
+app.config["HASH_WORKERS"] = int(os.getenv("HASH_WORKERS") or 2)
+app.config["HASH_QUEUE_SIZE"] = int(os.getenv("HASH_QUEUE_SIZE") or 32)
+app.config["PROFILE_SAMPLE_RATE"] = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+app.config["PROFILE_SLOW_MS"] = float(os.getenv("PROFILE_SLOW_MS") or 500)
+app.config["PROFILE_DIR"] = os.getenv("PROFILE_DIR") or "profiles"
 if os.getenv("TESTING") == "TRUE":
     mongo_client = mongomock.MongoClient()
 else:
-    mongo_client = MongoClient(os.getenv("MONGO_URI"))
+    mongo_client = MongoClient(os.getenv("MONGO_URI"), maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE") or 100),
+                               event_listeners=[CommandTimer()])
 db = mongo_client[os.getenv("MONGO_DB_NAME")]
 DEFAULT_GLYCEMIC_RANGES = [3.0, 3.9, 10.0, 13.9]
 DEFAULT_GLYCEMIC_TARGETS = [0.01, 0.04, 0.7, 0.25, 0.05]
 
 from fullstack.views import *
 
+install(app)
+
 UserView.register(app, route_base="/api/v1/user")
 DataView.register(app, route_base="/api/v1/data")
 DiagnosisView.register(app, route_base="/api/v1/diagnosis")
 NoteView.register(app, route_base="/api/v1/note")
+MetricsView.register(app, route_base="/api/v1/metrics")
@@ -0,0 +1,303 @@
+"""
+Author: Alexander
+Description: Vectorized analytics over CGM time series. Everything in here works on plain numpy arrays of
+             timestamps (seconds since epoch) and values, so it can be fed from a cursor, an aggregation
+             or precomputed sums without caring where the data came from.
+"""
+from typing import List, Optional, Sequence
+import time
+
+import numpy as np
+
+SLOTS = 96
+SLOT_SECONDS = 15 * 60
+DAY_SECONDS = 24 * 60 * 60
+
+
+def _utc_offset(timestamp: float) -> int:
+    return time.localtime(timestamp).tm_gmtoff
+
+
+def local_offsets(timestamps: np.ndarray) -> np.ndarray:
+    """
+    Finds the UTC offset of the local timezone at every timestamp, so wall clock time can be computed
+    without calling datetime.fromtimestamp for every reading
+    :param timestamps: Array of seconds since epoch
+    :return: Array of offsets in seconds
+    """
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=np.int64)
+    first, last = timestamps.min(), timestamps.max()
+    offset = _utc_offset(first)
+    # Timezone changes are months apart, so a short window with the same offset at both ends has no change inside
+    if last - first < 28 * DAY_SECONDS and _utc_offset(last) == offset:
+        return np.full(len(timestamps), offset, dtype=np.int64)
+
+    # Offsets only ever change on a quarter hour, so it's enough to look up each quarter once
+    quarters, inverse = np.unique(timestamps // SLOT_SECONDS, return_inverse=True)
+    offsets = np.array([_utc_offset(q * SLOT_SECONDS) for q in quarters], dtype=np.int64)
+    return offsets[inverse]
+
+
+def get_slots(timestamps: np.ndarray) -> np.ndarray:
+    """
+    Gets the 15-minute slot of the day (0-95) in local time for every timestamp
+    :param timestamps: Array of seconds since epoch
+    :return: Array of slot indices
+    """
+    local = timestamps.astype(np.int64) + local_offsets(timestamps)
+    return (local % DAY_SECONDS) // SLOT_SECONDS
+
+
+def get_bands(ranges: Sequence[float], values: np.ndarray) -> np.ndarray:
+    """
+    Gets the glycemic band of every value, where band i is below ranges[i] and band len(ranges) is above all of them
+    :param ranges: Sorted glycemic range boundaries
+    :param values: Array of glucose values
+    :return: Array of band indices
+    """
+    return np.searchsorted(np.asarray(ranges, dtype=np.float64), values, side='right')
+
+
+def accumulate(timestamps: np.ndarray, values: np.ndarray, start_time: float, ranges: Sequence[float]) -> dict:
+    """
+    Reduces a series to the running sums a preview is made of. Every reading is weighted with the time since the
+    previous reading (or since start_time for the first one) in the distribution
+    :param timestamps: Sorted array of seconds since epoch
+    :param values: Array of glucose values
+    :param start_time: Start of the window in seconds since epoch
+    :param ranges: Glycemic range boundaries
+    :return: A dict with per-slot 'sums' and 'counts', per-band 'band_time' in seconds and the 'end' timestamp
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    slots = get_slots(timestamps)
+    dt = np.diff(timestamps, prepend=start_time)
+    return {
+        'sums': np.bincount(slots, weights=values, minlength=SLOTS),
+        'counts': np.bincount(slots, minlength=SLOTS),
+        'band_time': np.bincount(get_bands(ranges, values), weights=dt, minlength=len(ranges) + 1),
+        'end': timestamps[-1] if len(timestamps) else start_time,
+    }
+
+
+def problem_mask(dist: np.ndarray, targets: Sequence[float]) -> np.ndarray:
+    """
+    Checks distributions against glycemic targets. Works on a single distribution or a (patients x 5) batch
+    :param dist: Distribution(s) over the 5 glycemic bands
+    :param targets: The 5 glycemic targets
+    :return: Boolean array of the same shape, true where a target isn't met
+    """
+    dist = np.asarray(dist, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    return np.stack([
+        dist[..., 0] > targets[0],
+        dist[..., 0] + dist[..., 1] > targets[1],
+        dist[..., 2] < targets[2],
+        dist[..., 3] + dist[..., 4] > targets[3],
+        dist[..., 4] > targets[4],
+    ], axis=-1)
+
+
+def check_distributions(dist: Sequence[float], targets: Sequence[float]) -> List[int]:
+    """
+    Gets the indices of the glycemic targets that aren't met by a distribution
+    :param dist: Distribution over the 5 glycemic bands
+    :param targets: The 5 glycemic targets
+    :return: List of problem indices
+    """
+    return np.flatnonzero(problem_mask(dist, targets)).tolist()
+
+
+def summarize(sums: np.ndarray, counts: np.ndarray, band_time: np.ndarray, total_time: float,
+              targets: Sequence[float]) -> dict:
+    """
+    Turns running sums into a preview
+    :param sums: Sum of values per slot
+    :param counts: Number of values per slot
+    :param band_time: Seconds spent in each glycemic band
+    :param total_time: Length of the window in seconds
+    :param targets: Glycemic targets
+    :return: A dict with slot means as 'values', 'distribution' and 'problems'
+    """
+    sums = np.asarray(sums, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    values: List[Optional[float]] = [None if c == 0 else m for m, c in zip(means.tolist(), counts.tolist())]
+
+    band_time = np.asarray(band_time, dtype=np.float64)
+    dist = band_time / total_time if total_time > 0 else np.zeros_like(band_time)
+    return {'values': values, 'distribution': dist.tolist(), 'problems': check_distributions(dist, targets)}
+
+
+def compute_preview(timestamps: np.ndarray, values: np.ndarray, start_time: float, ranges: Sequence[float],
+                    targets: Sequence[float]) -> dict:
+    """
+    Computes a preview of a patient: the mean per 15-minute slot of the day, the time-weighted distribution over the
+    glycemic bands and which targets aren't met
+    :param timestamps: Sorted array of seconds since epoch
+    :param values: Array of glucose values
+    :param start_time: Start of the window in seconds since epoch
+    :param ranges: Glycemic range boundaries
+    :param targets: Glycemic targets
+    :return: A dict with 'values', 'distribution' and 'problems'
+    """
+    acc = accumulate(timestamps, values, start_time, ranges)
+    return summarize(acc['sums'], acc['counts'], acc['band_time'], acc['end'] - start_time, targets)
+
+
+def downsample(timestamps: np.ndarray, values: np.ndarray, resolution: int) -> dict:
+    """
+    Aggregates a series into buckets of resolution seconds, aligned to local wall clock time
+    :param timestamps: Sorted array of seconds since epoch
+    :param values: Array of values
+    :param resolution: Bucket size in seconds
+    :return: A dict of arrays with the bucket start 't', mean 'v', 'min', 'max' and number of readings 'n'
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(timestamps) == 0:
+        return {'t': timestamps, 'v': values, 'min': values, 'max': values, 'n': timestamps}
+    offsets = local_offsets(timestamps)
+    buckets = (timestamps + offsets) // resolution
+    # Timestamps are sorted, so every bucket is a contiguous run
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    counts = np.diff(starts, append=len(buckets))
+    return {
+        't': buckets[starts] * resolution - offsets[starts],
+        'v': np.add.reduceat(values, starts) / counts,
+        'min': np.minimum.reduceat(values, starts),
+        'max': np.maximum.reduceat(values, starts),
+        'n': counts,
+    }
+
+
+AGP_PERCENTILES = [5, 25, 50, 75, 95]
+MGDL_PER_MMOL = 18.016
+
+
+def slot_percentiles(slots: np.ndarray, values: np.ndarray, percentiles: Sequence[float]) -> np.ndarray:
+    """
+    Computes percentiles of the values in every slot at once, interpolating linearly like np.percentile
+    :param slots: Array of slot indices (0-95)
+    :param values: Array of values
+    :param percentiles: Percentiles between 0 and 100
+    :return: A (SLOTS x percentiles) array, nan for empty slots
+    """
+    if len(values) == 0:
+        return np.full((SLOTS, len(percentiles)), np.nan)
+    # Sorted by slot and then by value, so every slot is a sorted run
+    sorted_values = values[np.lexsort((values, slots))]
+    counts = np.bincount(slots, minlength=SLOTS)
+    starts = np.cumsum(counts) - counts
+
+    position = np.maximum(counts[:, None] - 1, 0) * (np.asarray(percentiles, dtype=np.float64)[None, :] / 100)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    # Empty slots read a value from another slot, which is masked afterwards
+    last = len(sorted_values) - 1
+    low_values = sorted_values[np.minimum(starts[:, None] + low, last)]
+    high_values = sorted_values[np.minimum(starts[:, None] + high, last)]
+    result = low_values + (high_values - low_values) * (position - low)
+    result[counts == 0] = np.nan
+    return result
+
+
+def gmi(mean):
+    """
+    Computes the glucose management indicator (Bergenstal et al. 2018), the HbA1c estimated from the mean glucose
+    :param mean: Mean glucose in mmol/L, a number or an array
+    :return: GMI in %
+    """
+    return 3.31 + 0.02392 * MGDL_PER_MMOL * mean
+
+
+def glycemic_metrics(timestamps: np.ndarray, values: np.ndarray, ranges: Sequence[float]) -> dict:
+    """
+    Computes the standard CGM metrics of a series: mean glucose, GMI, coefficient of variation, the fraction of
+    readings in each glycemic band and the ambulatory glucose profile (AGP)
+    :param timestamps: Array of seconds since epoch
+    :param values: Array of glucose values in mmol/L
+    :param ranges: Glycemic range boundaries
+    :return: A dict with 'readings', 'mean', 'sd', 'cv' (%), 'gmi' (%), 'distribution' over the bands, 'tbr', 'tir'
+             and 'tar' (fractions of readings below, in and above the middle band) and 'agp', the AGP_PERCENTILES
+             per 15-minute slot (None for empty slots). Everything but 'readings' and 'agp' is None without readings
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    agp = slot_percentiles(get_slots(timestamps), values, AGP_PERCENTILES)
+    out = {'readings': n,
+           'agp': {str(p): [None if np.isnan(v) else v for v in agp[:, i].tolist()]
+                   for i, p in enumerate(AGP_PERCENTILES)}}
+    if n == 0:
+        return dict(out, mean=None, sd=None, cv=None, gmi=None, distribution=None, tbr=None, tir=None, tar=None)
+
+    mean = float(values.mean())
+    sd = float(values.std())
+    dist = np.bincount(get_bands(ranges, values), minlength=len(ranges) + 1) / n
+    middle = len(ranges) // 2
+    return dict(out, mean=mean, sd=sd, cv=sd / mean * 100,
+                gmi=gmi(mean),
+                distribution=dist.tolist(), tbr=float(dist[:middle].sum()), tir=float(dist[middle]),
+                tar=float(dist[middle + 1:].sum()))
+
+
+COHORT_METRICS = ['readings', 'mean', 'sd', 'cv', 'gmi', 'tbr', 'tir', 'tar', 'hypos']
+
+
+def cohort_sums(patient_index: np.ndarray, values: np.ndarray, patients: int, ranges: Sequence[float]) -> dict:
+    """
+    Reduces the readings of many patients at once to the sums the cohort metrics are made of. The readings of all
+    patients are laid out one after another, sorted by patient and then by time
+    :param patient_index: Array with the index of the patient of every reading
+    :param values: Array of glucose values
+    :param patients: Number of patients
+    :param ranges: Glycemic range boundaries
+    :return: A dict of per-patient arrays 'readings', 'sum', 'sumsq', 'bands' (patients x bands) and 'hypos', the
+             number of times the patient went below ranges[1]
+    """
+    patient_index = np.asarray(patient_index, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    nbands = len(ranges) + 1
+    bands = np.bincount(patient_index * nbands + get_bands(ranges, values), minlength=patients * nbands)
+
+    below = values < ranges[1]
+    # A hypo starts at every reading below range that doesn't follow a reading below range of the same patient
+    continued = np.zeros_like(below)
+    continued[1:] = below[:-1] & (patient_index[1:] == patient_index[:-1])
+    starts = below & ~continued
+    return {
+        'readings': np.bincount(patient_index, minlength=patients),
+        'sum': np.bincount(patient_index, weights=values, minlength=patients),
+        'sumsq': np.bincount(patient_index, weights=values * values, minlength=patients),
+        'bands': bands.reshape(patients, nbands),
+        'hypos': np.bincount(patient_index[starts], minlength=patients),
+    }
+
+
+def cohort_metrics(sums: dict) -> dict:
+    """
+    Computes the metrics of glycemic_metrics (without the AGP) and the number of hypos for many patients at once
+    :param sums: Per-patient sums, see cohort_sums
+    :return: A dict of COHORT_METRICS to per-patient arrays, nan for patients without readings (but 0 readings)
+    """
+    n = np.asarray(sums['readings'], dtype=np.float64)
+    bands = np.asarray(sums['bands'], dtype=np.float64)
+    middle = bands.shape[1] // 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums['sum'] / n
+        sd = np.sqrt(np.maximum(sums['sumsq'] / n - mean * mean, 0))
+        dist = bands / n[:, None]
+        return {
+            'readings': n,
+            'mean': mean,
+            'sd': sd,
+            'cv': sd / mean * 100,
+            'gmi': gmi(mean),
+            'tbr': dist[:, :middle].sum(axis=1),
+            'tir': dist[:, middle],
+            'tar': dist[:, middle + 1:].sum(axis=1),
+            'hypos': np.where(n > 0, sums['hypos'], np.nan),
+        }
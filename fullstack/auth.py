@@ -0,0 +1,80 @@
+"""
+Author: Alexander
+Description: Caching of the authenticated user ("principal") data every request needs, so get_login doesn't
+             have to fetch the user from the database on every API call.
+             The cache is per process, so entries are invalidated explicitly where this process changes them and
+             otherwise expire after PRINCIPAL_CACHE_TTL seconds.
+"""
+from collections import OrderedDict
+from threading import Lock
+from types import MappingProxyType
+from typing import Mapping, Optional
+import time
+
+from fullstack import app
+
+# The only user fields that are part of a principal
+PRINCIPAL_FIELDS = {'_id': 1, 'is_doctor': 1, 'viewable': 1, 'glycemic_ranges': 1, 'glycemic_targets': 1,
+                    'token_version': 1}
+
+
+def make_principal(user: dict) -> Mapping:
+    """
+    Turns a user object into a read-only principal. Besides the PRINCIPAL_FIELDS it has 'can_view', a frozenset of
+    the ids the user is allowed to view (including the user itself), so permission checks are a set lookup
+    :param user: User object with at least the PRINCIPAL_FIELDS that are set
+    :return: Read-only principal
+    """
+    principal = {key: user[key] for key in PRINCIPAL_FIELDS if key in user and key != 'viewable'}
+    principal['can_view'] = frozenset([*(user.get('viewable') or []), user['_id']])
+    return MappingProxyType(principal)
+
+
+class PrincipalCache:
+    """
+    A thread safe LRU cache with a time to live, keyed by user id
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id) -> Optional[Mapping]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, principal: Mapping):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+principal_cache = PrincipalCache(app.config["PRINCIPAL_CACHE_SIZE"], app.config["PRINCIPAL_CACHE_TTL"])
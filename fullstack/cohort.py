@@ -0,0 +1,114 @@
+"""
+Author: Alexander
+Description: Metrics of a doctor's whole panel at once, to rank patients by e.g. time below range or hypos.
+             All patients are reduced with a single query: by default an aggregation pipeline that only sends the
+             per-patient sums over the wire, otherwise (mongomock, MongoDB before 5.0) the raw readings of all
+             patients are fetched with one $in query and reduced with numpy, see analytics.cohort_sums
+"""
+from typing import List, Optional
+import datetime
+
+import numpy as np
+from pymongo.errors import OperationFailure
+
+from fullstack import app, db, DEFAULT_GLYCEMIC_RANGES
+from fullstack.analytics import COHORT_METRICS, cohort_metrics, cohort_sums
+from fullstack.previews import band_expression
+from fullstack.series import supports_aggregation, time_condition
+
+COUNTS = {'readings', 'hypos'}
+
+
+def cohort_pipeline(patient_ids: List, start_time: datetime.datetime, end_time: Optional[datetime.datetime]) -> list:
+    """
+    Builds a pipeline summing up the cgm readings of all the given patients, like analytics.cohort_sums
+    """
+    threshold = DEFAULT_GLYCEMIC_RANGES[1]
+    nbands = len(DEFAULT_GLYCEMIC_RANGES) + 1
+    band = band_expression(DEFAULT_GLYCEMIC_RANGES)
+    return [
+        {'$match': {'patient': {'$in': patient_ids}, 'timestamp': time_condition(start_time, end_time)}},
+        {'$setWindowFields': {
+            'partitionBy': '$patient',
+            'sortBy': {'timestamp': 1},
+            'output': {'previous': {'$shift': {'output': '$value', 'by': -1, 'default': threshold}}}
+        }},
+        {'$set': {'band': band}},
+        {'$group': {
+            '_id': '$patient',
+            'readings': {'$sum': 1},
+            'sum': {'$sum': '$value'},
+            'sumsq': {'$sum': {'$multiply': ['$value', '$value']}},
+            **{f'band{i}': {'$sum': {'$cond': [{'$eq': ['$band', i]}, 1, 0]}} for i in range(nbands)},
+            'hypos': {'$sum': {'$cond': [{'$and': [{'$lt': ['$value', threshold]},
+                                                   {'$gte': ['$previous', threshold]}]}, 1, 0]}},
+        }},
+    ]
+
+
+def _aggregate(patient_ids: List, start_time: datetime.datetime, end_time: Optional[datetime.datetime]) -> dict:
+    n = len(patient_ids)
+    nbands = len(DEFAULT_GLYCEMIC_RANGES) + 1
+    position = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+    sums = {'readings': np.zeros(n, dtype=np.int64), 'sum': np.zeros(n), 'sumsq': np.zeros(n),
+            'bands': np.zeros((n, nbands), dtype=np.int64), 'hypos': np.zeros(n, dtype=np.int64)}
+    for row in db.cgm.aggregate(cohort_pipeline(patient_ids, start_time, end_time)):
+        i = position[row['_id']]
+        for key in ['readings', 'sum', 'sumsq', 'hypos']:
+            sums[key][i] = row[key]
+        sums['bands'][i] = [row[f'band{b}'] for b in range(nbands)]
+    return sums
+
+
+def _accumulate(patient_ids: List, start_time: datetime.datetime, end_time: Optional[datetime.datetime]) -> dict:
+    position = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+    data = list(db.cgm.find({'patient': {'$in': patient_ids}, 'timestamp': time_condition(start_time, end_time)},
+                            {'patient': 1, 'timestamp': 1, 'value': 1, '_id': 0}))
+    index = np.fromiter((position[d['patient']] for d in data), dtype=np.int64, count=len(data))
+    timestamps = np.fromiter((d['timestamp'].timestamp() for d in data), dtype=np.float64, count=len(data))
+    values = np.fromiter((d['value'] for d in data), dtype=np.float64, count=len(data))
+    order = np.lexsort((timestamps, index))
+    return cohort_sums(index[order], values[order], len(patient_ids), DEFAULT_GLYCEMIC_RANGES)
+
+
+def get_cohort_metrics(patient_ids: List, start_time: datetime.datetime,
+                       end_time: Optional[datetime.datetime] = None) -> dict:
+    """
+    Computes the metrics of many patients with one query
+    :param patient_ids: ObjectIds of the patients
+    :param start_time: Start of the window
+    :param end_time: Exclusive end of the window, or None for up to now
+    :return: A dict of COHORT_METRICS to arrays in the order of patient_ids, see analytics.cohort_metrics
+    """
+    sums = None
+    if supports_aggregation():
+        try:
+            sums = _aggregate(patient_ids, start_time, end_time)
+        except OperationFailure as e:
+            app.logger.warning("Cohort aggregation failed, falling back to numpy: %s", e)
+    if sums is None:
+        sums = _accumulate(patient_ids, start_time, end_time)
+    return cohort_metrics(sums)
+
+
+def rank(metrics: dict, sort: str, descending: bool, offset: int, limit: int) -> List[dict]:
+    """
+    Sorts patients by a metric and takes a page, patients without readings last
+    :param metrics: Per-patient metrics, see get_cohort_metrics
+    :param sort: The metric to sort by, one of COHORT_METRICS
+    :param descending: Whether the highest values come first
+    :param offset: Number of patients to skip
+    :param limit: Maximum number of patients
+    :return: A list of (patient index, metrics) tuples
+    """
+    key = metrics[sort]
+    # argsort puts nan last either way
+    order = np.argsort(-key if descending else key, kind='stable')[offset:offset + limit]
+    page = []
+    for i in order.tolist():
+        row = {}
+        for name in COHORT_METRICS:
+            value = metrics[name][i]
+            row[name] = None if np.isnan(value) else int(value) if name in COUNTS else float(value)
+        page.append((i, row))
+    return page
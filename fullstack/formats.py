@@ -0,0 +1,85 @@
+"""
+Author: Alexander
+Description: Compact wire formats for time series responses, as an alternative to a list of {"t": ..., "v": ...}
+             objects per data type. Both take a dict of data type to sorted (timestamps, values) numpy arrays.
+             Exercise also has a third array with the durations in seconds (NaN where there's none).
+             columnar: {type: {"t": [...], "v": [...]}} where the first timestamp is absolute and every following
+                       one is the difference to the one before it, so the original timestamps are the cumulative sum.
+                       The durations of exercise are in "d", null where there's none
+             binary:   For every data type, little-endian and without padding:
+                       uint8 length of the type name, the type name in ASCII, uint32 number of readings n,
+                       int64 first timestamp, int32[n] timestamp differences (the first one is 0), float32[n] values
+                       The durations of exercise follow as a data type of its own named "exercise.d", with the
+                       same timestamps and the durations as values
+"""
+from typing import Dict, Tuple
+import struct
+
+import numpy as np
+
+FORMATS = ['records', 'columnar', 'binary']
+BINARY_MIMETYPE = 'application/octet-stream'
+
+
+def delta_encode(timestamps: np.ndarray) -> np.ndarray:
+    return np.diff(timestamps.astype(np.int64), prepend=0)
+
+
+def encode_columnar(series: Dict[str, Tuple[np.ndarray, ...]]) -> dict:
+    """
+    Encodes time series as columnar JSON with delta encoded timestamps
+    :param series: A dict of data type to (timestamps, values) or (timestamps, values, durations)
+    :return: A JSON serializable dict
+    """
+    out = {}
+    for col, (t, v, *durations) in series.items():
+        out[col] = {'t': delta_encode(t).tolist(), 'v': v.tolist()}
+        if durations:
+            out[col]['d'] = [None if np.isnan(d) else d for d in durations[0].tolist()]
+    return out
+
+
+def _binary_block(col: str, t: np.ndarray, v: np.ndarray) -> bytes:
+    name = col.encode('ascii')
+    deltas = delta_encode(t)
+    base = int(deltas[0]) if len(deltas) else 0
+    if len(deltas):
+        deltas[0] = 0
+    return struct.pack('<B', len(name)) + name + struct.pack('<Iq', len(t), base) + deltas.astype('<i4').tobytes() + \
+        v.astype('<f4').tobytes()
+
+
+def encode_binary(series: Dict[str, Tuple[np.ndarray, ...]]) -> bytes:
+    """
+    Encodes time series as packed little-endian arrays
+    :param series: A dict of data type to (timestamps, values) or (timestamps, values, durations)
+    :return: The encoded bytes
+    """
+    out = []
+    for col, (t, v, *durations) in series.items():
+        out.append(_binary_block(col, t, v))
+        if durations:
+            out.append(_binary_block(f'{col}.d', t, durations[0]))
+    return b''.join(out)
+
+
+def decode_binary(data: bytes) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Decodes the output of encode_binary
+    :param data: The encoded bytes
+    :return: A dict of data type to (timestamps, values)
+    """
+    out = {}
+    pos = 0
+    while pos < len(data):
+        length = data[pos]
+        col = data[pos + 1:pos + 1 + length].decode('ascii')
+        pos += 1 + length
+        n, base = struct.unpack_from('<Iq', data, pos)
+        pos += 12
+        deltas = np.frombuffer(data, dtype='<i4', count=n, offset=pos).astype(np.int64)
+        pos += 4 * n
+        values = np.frombuffer(data, dtype='<f4', count=n, offset=pos)
+        pos += 4 * n
+        out[col] = (base + np.cumsum(deltas), values)
+    return out
@@ -0,0 +1,170 @@
+"""
+Author: Alexander
+Description: Per-request timing instrumentation. Every request records how long it spent in a couple of spans
+             (auth, db, compute, serialize, plus the total), which are aggregated into histograms per endpoint and
+             shown on the metrics endpoint. Spans can overlap, e.g. db time spent while computing previews counts
+             towards both db and compute.
+             Database time comes from pymongo command monitoring. Commands run outside of a request context
+             (like the thread pool in series.fetch_parallel) are only counted in the per-command histograms.
+             Optionally, a sample of the requests is profiled with cProfile and the profiles of slow ones are dumped.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+import cProfile
+import datetime
+import os
+import random
+
+from flask import Flask, g, has_app_context, request
+from pymongo import monitoring
+
+# Upper bounds of the histogram buckets in milliseconds
+BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+
+
+class Histogram:
+    """
+    A thread safe histogram of durations in milliseconds
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, ms: float):
+        with self._lock:
+            for i, bound in enumerate(BUCKETS):
+                if ms <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += ms
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {'count': self.count, 'sum_ms': self.sum,
+                    'buckets': {('+Inf' if bound == float('inf') else str(bound)): count
+                                for bound, count in zip(BUCKETS, self.counts)}}
+
+
+class Registry:
+    """
+    Histograms of request spans per endpoint and of database commands per command name
+    """
+
+    def __init__(self):
+        self.requests = defaultdict(lambda: defaultdict(Histogram))
+        self.commands = defaultdict(Histogram)
+        self._lock = Lock()
+
+    def observe_request(self, endpoint: str, spans: dict):
+        with self._lock:
+            histograms = self.requests[endpoint]
+            histograms = {name: histograms[name] for name in spans}
+        for name, ms in spans.items():
+            histograms[name].observe(ms)
+
+    def observe_command(self, command: str, ms: float):
+        with self._lock:
+            histogram = self.commands[command]
+        histogram.observe(ms)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            requests = {endpoint: dict(spans) for endpoint, spans in self.requests.items()}
+            commands = dict(self.commands)
+        return {'requests': {endpoint: {name: h.to_dict() for name, h in spans.items()}
+                             for endpoint, spans in requests.items()},
+                'commands': {name: h.to_dict() for name, h in commands.items()}}
+
+
+registry = Registry()
+
+
+def add_span(name: str, ms: float):
+    """
+    Adds time to a span of the current request, if there is one
+    """
+    if has_app_context() and 'spans' in g:
+        g.spans[name] += ms
+
+
+@contextmanager
+def span(name: str):
+    """
+    Times a block of code as a span of the current request
+    """
+    begin = perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, (perf_counter() - begin) * 1000)
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Times all database commands and adds them to the db span of the request they were run in
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    @staticmethod
+    def _record(event):
+        ms = event.duration_micros / 1000
+        registry.observe_command(event.command_name, ms)
+        add_span('db', ms)
+
+
+def _before_request():
+    g.spans = defaultdict(float)
+    g.request_start = perf_counter()
+    g.profiler = None
+    from fullstack import app
+    if random.random() < app.config["PROFILE_SAMPLE_RATE"]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this process
+            return
+        g.profiler = profiler
+
+
+def _after_request(response):
+    if 'spans' not in g:
+        return response
+    total = (perf_counter() - g.request_start) * 1000
+    spans = dict(g.spans)
+    spans['total'] = total
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    registry.observe_request(f'{request.method} {endpoint}', spans)
+
+    if g.profiler is not None:
+        from fullstack import app
+        g.profiler.disable()
+        if total >= app.config["PROFILE_SLOW_MS"]:
+            os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+            name = f"{request.method}-{request.path.strip('/').replace('/', '_')}-" \
+                   f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}.prof"
+            g.profiler.dump_stats(os.path.join(app.config["PROFILE_DIR"], name))
+        g.profiler = None
+    return response
+
+
+def install(app: Flask):
+    """
+    Hooks the request instrumentation into the app
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
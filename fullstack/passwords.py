@@ -0,0 +1,102 @@
+"""
+Author: Alexander
+Description: Password hashing on a pool of worker processes. bcrypt is slow on purpose, so it's kept off the request
+             threads, and the number of hashes waiting for a process is bounded so a burst of logins is turned away
+             with a 503 instead of piling up behind each other.
+             New hashes use BCRYPT_ROUNDS, and hashes with another work factor are replaced on the next login
+"""
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from time import perf_counter
+import multiprocessing
+
+import bcrypt
+
+from fullstack import app
+from fullstack.metrics import Histogram, span
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+_executor = None
+_lock = Lock()
+_pending = 0
+_rejected = 0
+_latency = Histogram()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Spawned rather than forked, so the processes don't inherit the MongoClient and only import bcrypt
+        _executor = ProcessPoolExecutor(max_workers=app.config["HASH_WORKERS"],
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def _run(function, *args):
+    """
+    Runs a bcrypt function on the pool, or in this thread with HASH_WORKERS set to 0
+    """
+    global _pending, _rejected
+    workers = app.config["HASH_WORKERS"]
+    with span('hash'):
+        if workers <= 0:
+            return function(*args)
+        with _lock:
+            if _pending >= workers + app.config["HASH_QUEUE_SIZE"]:
+                _rejected += 1
+                raise HashQueueFull()
+            _pending += 1
+            future = _get_executor().submit(function, *args)
+        start = perf_counter()
+        try:
+            return future.result()
+        finally:
+            _latency.observe((perf_counter() - start) * 1000)
+            with _lock:
+                _pending -= 1
+
+
+def hash_password(password: str) -> str:
+    """
+    Hashes a password with the configured work factor
+    :raise HashQueueFull: If too many hashes are waiting already
+    """
+    salt = bcrypt.gensalt(app.config["BCRYPT_ROUNDS"])
+    return _run(bcrypt.hashpw, password.encode('utf-8'), salt).decode()
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    """
+    Checks a password against a hash
+    :raise HashQueueFull: If too many hashes are waiting already
+    """
+    return _run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode())
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """
+    Whether a hash was made with another work factor than the configured one
+    """
+    return int(password_hash.split('$')[2]) != app.config["BCRYPT_ROUNDS"]
+
+
+def stats() -> dict:
+    with _lock:
+        pending, rejected = _pending, _rejected
+    return {'pending': pending, 'workers': app.config["HASH_WORKERS"], 'rejected': rejected,
+            'latency': _latency.to_dict()}
+
+
+def shutdown():
+    """
+    Waits for running hashes and stops the process pool, for a graceful shutdown of the server
+    """
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
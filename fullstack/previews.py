@@ -0,0 +1,307 @@
+"""
+Author: Alexander
+Description: Computation of the per-patient previews shown on the doctor dashboard.
+             Every patient has a rolling state in db.cache holding the running sums a preview is made of: sum and
+             count per 15-minute slot and time per glycemic band over the last NDAYS days. New cgm readings are
+             added to it as they are uploaded and readings older than the window are subtracted when it is read,
+             so a preview never has to be recomputed from scratch.
+             States are only built from the raw readings when they're missing or the glycemic ranges of the
+             patient have changed, which bumps the 'settings_version' of the user. A state is stored with the
+             version it was built for, one per patient (unique index), and states nobody has read or refreshed
+             for CACHE_IDLE_DAYS days are removed by a TTL index on 'expires'.
+             By default that reduction is done inside MongoDB with an aggregation pipeline, so only the per-slot
+             and per-band sums are sent over the wire. Where the pipeline isn't supported (mongomock, MongoDB
+             before 5.0) the raw readings are fetched and reduced with the numpy engine instead.
+"""
+from typing import Dict, List, Optional, Sequence
+import datetime
+
+import numpy as np
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from fullstack import app, db, DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS
+from fullstack.analytics import SLOTS, accumulate, summarize
+from fullstack.series import get_series_batch, supports_aggregation, to_arrays
+
+NDAYS = 14
+CACHE_IDLE_DAYS = 7
+# The window is moved forward in steps, so reading a preview doesn't query for aged out readings every time
+TRIM_STEP = datetime.timedelta(minutes=15)
+
+
+def band_expression(ranges: Sequence[float]) -> dict:
+    """
+    Aggregation expression equivalent to analytics.get_bands for a single set of ranges
+    """
+    return {'$switch': {
+        'branches': [{'case': {'$lt': ['$value', r]}, 'then': i} for i, r in enumerate(ranges)],
+        'default': len(ranges)
+    }}
+
+
+def preview_pipeline(patients: List[dict], start_time: datetime.datetime) -> list:
+    """
+    Builds a pipeline summing up the cgm readings of all the given patients per (patient, slot, band).
+    Every reading is weighted with the time since the previous reading, exactly like analytics.accumulate
+    :param patients: User objects with '_id' and optionally 'glycemic_ranges'
+    :param start_time: Start of the window
+    :return: An aggregation pipeline for the cgm collection
+    """
+    groups = {}
+    for patient in patients:
+        ranges = tuple(patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES)
+        groups.setdefault(ranges, []).append(patient['_id'])
+
+    if len(groups) == 1:
+        band = band_expression(next(iter(groups)))
+    else:
+        band = {'$switch': {
+            'branches': [{'case': {'$in': ['$patient', ids]}, 'then': band_expression(ranges)}
+                         for ranges, ids in groups.items()]
+        }}
+
+    slot = {'$add': [{'$multiply': [{'$hour': '$timestamp'}, 4]},
+                     {'$floor': {'$divide': [{'$minute': '$timestamp'}, 15]}}]}
+    return [
+        {'$match': {'patient': {'$in': [patient['_id'] for patient in patients]}, 'timestamp': {'$gte': start_time}}},
+        {'$setWindowFields': {
+            'partitionBy': '$patient',
+            'sortBy': {'timestamp': 1},
+            'output': {'previous': {'$shift': {'output': '$timestamp', 'by': -1, 'default': start_time}}}
+        }},
+        {'$group': {
+            '_id': {'patient': '$patient', 'slot': slot, 'band': band},
+            'sum': {'$sum': '$value'},
+            'count': {'$sum': 1},
+            'time': {'$sum': {'$subtract': ['$timestamp', '$previous']}},
+            'end': {'$max': '$timestamp'}
+        }},
+    ]
+
+
+def _aggregate(patients: List[dict], start_time: datetime.datetime) -> Dict:
+    accumulated = {}
+    for row in db.cgm.aggregate(preview_pipeline(patients, start_time)):
+        key = row['_id']
+        acc = accumulated.get(key['patient'])
+        if acc is None:
+            acc = {'sums': np.zeros(SLOTS), 'counts': np.zeros(SLOTS, dtype=np.int64),
+                   'band_time': np.zeros(len(DEFAULT_GLYCEMIC_RANGES) + 1), 'end': start_time.timestamp()}
+            accumulated[key['patient']] = acc
+        acc['sums'][int(key['slot'])] += row['sum']
+        acc['counts'][int(key['slot'])] += row['count']
+        acc['band_time'][key['band']] += row['time'] / 1000
+        acc['end'] = max(acc['end'], int(row['end'].timestamp()))
+    return accumulated
+
+
+def _accumulate(patients: List[dict], start_time: datetime.datetime) -> Dict:
+    series = get_series_batch([patient['_id'] for patient in patients], 'cgm', start_time)
+    accumulated = {}
+    for patient in patients:
+        if patient['_id'] in series:
+            timestamps, values = series[patient['_id']]
+            accumulated[patient['_id']] = accumulate(timestamps, values, start_time.timestamp(),
+                                                     patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES)
+    return accumulated
+
+
+def accumulate_previews(patients: List[dict], start_time: datetime.datetime) -> Dict:
+    """
+    Computes the running sums of several patients at once from the raw readings
+    :param patients: User objects with '_id' and optionally 'glycemic_ranges'
+    :param start_time: Start of the window
+    :return: A dict of patient id to running sums, see analytics.accumulate
+    """
+    if not patients:
+        return {}
+
+    accumulated = None
+    if app.config["PREVIEW_ENGINE"] == "aggregate" and supports_aggregation():
+        try:
+            accumulated = _aggregate(patients, start_time)
+        except OperationFailure as e:
+            app.logger.warning("Preview aggregation failed, falling back to numpy: %s", e)
+    if accumulated is None:
+        accumulated = _accumulate(patients, start_time)
+
+    for patient in patients:
+        if patient['_id'] not in accumulated:
+            accumulated[patient['_id']] = accumulate(np.zeros(0), np.zeros(0), start_time.timestamp(),
+                                                     patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES)
+    return accumulated
+
+
+def _increments(acc: dict, sign: int) -> dict:
+    inc = {}
+    for i in np.flatnonzero(acc['counts']):
+        inc[f'sums.{i}'] = sign * float(acc['sums'][i])
+        inc[f'counts.{i}'] = sign * int(acc['counts'][i])
+    for i in np.flatnonzero(acc['band_time']):
+        inc[f'band_time.{i}'] = sign * float(acc['band_time'][i])
+    return inc
+
+
+def _expires() -> datetime.datetime:
+    return datetime.datetime.utcnow() + datetime.timedelta(days=CACHE_IDLE_DAYS)
+
+
+def _mark_building(patient_ids: List, token: ObjectId) -> Dict:
+    """
+    Marks the states of patients as being built, inserting placeholders where there are none
+    :return: A dict of patient id to the _id of its state
+    """
+    updates = [UpdateOne({'patient': patient_id}, {'$set': {'building': token}, '$setOnInsert': {'expires': _expires()}},
+                         upsert=True) for patient_id in patient_ids]
+    try:
+        db.cache.bulk_write(updates, ordered=False)
+    except BulkWriteError as e:
+        # Another request inserted the same placeholder at once, which the unique index rejects, so it is marked again
+        retry = [updates[err['index']] for err in e.details['writeErrors'] if err['code'] == 11000]
+        if len(retry) < len(e.details['writeErrors']):
+            raise
+        db.cache.bulk_write(retry, ordered=False)
+    return {doc['patient']: doc['_id'] for doc in db.cache.find({'building': token}, {'patient': 1})}
+
+
+def _build_states(patients: List[dict], start_time: datetime.datetime) -> Dict:
+    if not patients:
+        return {}
+    # Readings recorded while the states are built may be missing from them, so record_readings drops states that
+    # are being built and only states still marked with this build's token are stored
+    token = ObjectId()
+    ids = _mark_building([patient['_id'] for patient in patients], token)
+    accumulated = accumulate_previews(patients, start_time)
+    states = {}
+    for patient in patients:
+        acc = accumulated[patient['_id']]
+        state = {
+            '_id': ids.get(patient['_id']) or ObjectId(),
+            'patient': patient['_id'], 'version': patient.get('settings_version', 0),
+            'ranges': list(patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES),
+            'start': start_time, 'last': datetime.datetime.fromtimestamp(acc['end']), 'expires': _expires(),
+            'sums': acc['sums'].tolist(), 'counts': acc['counts'].tolist(), 'band_time': acc['band_time'].tolist()
+        }
+        # Otherwise the state is still right for this read, and is built again by the next one
+        db.cache.replace_one({'_id': state['_id'], 'building': token}, state)
+        states[patient['_id']] = state
+    return states
+
+
+def _trim(state: dict, start_time: datetime.datetime) -> Optional[dict]:
+    """
+    Subtracts the readings that have aged out of the window from a state
+    :return: The updated state, or None if it was changed concurrently and has to be read again
+    """
+    old_start = state['start']
+    if start_time - old_start < TRIM_STEP:
+        return state
+
+    projection = {'timestamp': 1, 'value': 1, '_id': 0}
+    leaving = list(db.cgm.find({'patient': state['patient'], 'timestamp': {'$gte': old_start, '$lt': start_time}},
+                               projection))
+    first = db.cgm.find_one({'patient': state['patient'], 'timestamp': {'$gte': start_time}}, projection,
+                            sort=[('timestamp', 1)])
+
+    if first is None:
+        # Nothing left in the window
+        update = {'$set': {'start': start_time, 'last': start_time, 'expires': _expires(), 'sums': [0.0] * SLOTS,
+                           'counts': [0] * SLOTS, 'band_time': [0.0] * len(state['band_time'])}}
+    else:
+        timestamps, values = to_arrays(leaving)
+        acc = accumulate(timestamps, values, old_start.timestamp(), state['ranges'])
+        # The first reading left in the window now only covers the time since the new start
+        previous = timestamps[-1] if len(timestamps) else old_start.timestamp()
+        first_acc = accumulate(np.array([start_time.timestamp()]), np.array([first['value']]), previous,
+                               state['ranges'])
+        acc['band_time'] += first_acc['band_time']
+        update = {'$inc': _increments(acc, -1), '$set': {'start': start_time, 'expires': _expires()}}
+        if not update['$inc']:
+            del update['$inc']
+
+    return db.cache.find_one_and_update({'_id': state['_id'], 'start': old_start}, update,
+                                        return_document=ReturnDocument.AFTER)
+
+
+def record_readings(patient_id, timestamps: List[datetime.datetime], values: List[float]):
+    """
+    Adds newly uploaded cgm readings to the rolling state of a patient. Readings that aren't newer than the newest
+    one already in the state can't be added incrementally (the state may have been built from them already), so the
+    state is dropped and rebuilt the next time it is read
+    :param patient_id: ObjectId of the patient
+    :param timestamps: Timestamps of the readings
+    :param values: Glucose values of the readings
+    """
+    state = db.cache.find_one({'patient': patient_id}, {'last': 1, 'ranges': 1, 'building': 1})
+    if state is None or not timestamps:
+        return
+    if 'building' in state:
+        # The state being built may have been read before these readings were stored
+        db.cache.delete_one({'_id': state['_id']})
+        return
+
+    timestamps, values = to_arrays([{'timestamp': t, 'value': v} for t, v in zip(timestamps, values)])
+    last = state['last'].timestamp()
+    if timestamps[0] <= last:
+        db.cache.delete_one({'_id': state['_id']})
+        return
+
+    acc = accumulate(timestamps, values, last, state['ranges'])
+    result = db.cache.update_one({'_id': state['_id'], 'last': state['last'], 'building': {'$exists': False}},
+                                 {'$inc': _increments(acc, 1), '$set': {'last': datetime.datetime.fromtimestamp(acc['end'])}})
+    if result.matched_count == 0:
+        # Another upload got there first, so the previous reading isn't known anymore, or a build started
+        db.cache.delete_one({'_id': state['_id']})
+
+
+def refresh_states(patients: List[dict]) -> Dict:
+    """
+    Makes sure the rolling states of several patients are up to date, building or trimming them where necessary
+    :param patients: User objects with '_id' and optionally 'glycemic_ranges' and 'settings_version'
+    :return: A dict of patient id to state
+    """
+    start_time = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=NDAYS)
+    states = {state['patient']: state for state in db.cache.find({'patient': {'$in': [p['_id'] for p in patients]}})}
+
+    missing = []
+    for patient in patients:
+        state = states.get(patient['_id'])
+        if state is not None and 'sums' not in state:
+            # Placeholder of a state being built
+            state = None
+        if state is not None:
+            if state.get('version') != patient.get('settings_version', 0) or \
+                    state['ranges'] != list(patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES):
+                state = None
+            else:
+                state = _trim(state, start_time)
+        if state is None:
+            missing.append(patient)
+        else:
+            states[patient['_id']] = state
+    states.update(_build_states(missing, start_time))
+    return states
+
+
+def load_previews(patients: List[dict]) -> list:
+    """
+    Gets the previews of several patients. When the precompute worker is running, the states are already up to date
+    and this only reads them
+    :param patients: User objects with '_id' and optionally 'glycemic_ranges', 'glycemic_targets' and
+                     'settings_version'
+    :return: A list of previews in the same order as patients
+    """
+    states = refresh_states(patients)
+
+    out = []
+    for patient in patients:
+        state = states[patient['_id']]
+        total_time = state['last'].timestamp() - state['start'].timestamp()
+        preview = summarize(state['sums'], state['counts'], np.maximum(state['band_time'], 0), total_time,
+                            patient.get('glycemic_targets') or DEFAULT_GLYCEMIC_TARGETS)
+        preview['_id'] = state['_id']
+        preview['patient'] = patient['_id']
+        out.append(preview)
+    return out
@@ -0,0 +1,185 @@
+"""
+Author: Alexander
+Description: Daily and hourly summaries of the data of every patient in db.rollups, so long windows can be summarized
+             from a few hundred documents instead of every reading. For cgm a rollup has the count, sum, sum of squares,
+             min and max of the readings and the time in each glycemic band, where every reading counts for the time
+             since the previous one (at most MAX_READING_SECONDS, so gaps in the data don't count). Daily rollups
+             also hold the totals of basal, bolus and meals.
+             Periods follow the local wall clock, like the stored timestamps. Rollups are updated incrementally as
+             data is stored; a reading inserted before readings that are already there doesn't correct the time of
+             the reading after it, which rebuild_rollups does
+"""
+from typing import Iterable, List, Optional
+import datetime
+
+import numpy as np
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from fullstack import db, DEFAULT_GLYCEMIC_RANGES
+from fullstack.analytics import get_bands
+from fullstack.series import time_condition
+
+PERIODS = {'day': 'datetime64[D]', 'hour': 'datetime64[h]'}
+TOTALS = ['basal', 'bolus', 'meals']
+MAX_READING_SECONDS = 15 * 60
+BANDS = len(DEFAULT_GLYCEMIC_RANGES) + 1
+
+
+def _buckets(timestamps: np.ndarray, period: str):
+    keys = timestamps.astype(PERIODS[period])
+    # Timestamps are sorted, so every bucket is a contiguous run
+    starts = np.flatnonzero(np.diff(keys.astype(np.int64), prepend=keys[0].astype(np.int64) - 1))
+    return keys[starts].astype('datetime64[us]').tolist(), starts
+
+
+def cgm_updates(patient_id, timestamps: np.ndarray, values: np.ndarray, previous: Optional[np.datetime64],
+                period: str) -> List[UpdateOne]:
+    """
+    Builds the upserts adding cgm readings to the rollups of a period
+    :param patient_id: ObjectId of the patient
+    :param timestamps: Sorted array of datetime64[s]
+    :param values: Array of glucose values
+    :param previous: Timestamp of the reading before the first one, if there is one
+    :param period: 'day' or 'hour'
+    :return: A list of UpdateOne operations for db.rollups
+    """
+    if len(timestamps) == 0:
+        return []
+    seconds = timestamps.astype(np.int64)
+    first = seconds[0] if previous is None else np.datetime64(previous, 's').astype(np.int64)
+    dt = np.clip(np.diff(seconds, prepend=first), 0, MAX_READING_SECONDS).astype(np.float64)
+
+    starts_at, starts = _buckets(timestamps, period)
+    index = np.repeat(np.arange(len(starts)), np.diff(starts, append=len(timestamps)))
+    band_time = np.bincount(index * BANDS + get_bands(DEFAULT_GLYCEMIC_RANGES, values), weights=dt,
+                            minlength=len(starts) * BANDS).reshape(len(starts), BANDS)
+    counts = np.diff(starts, append=len(timestamps))
+    sums = np.add.reduceat(values, starts)
+    sumsqs = np.add.reduceat(values * values, starts)
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+
+    updates = []
+    for i, start in enumerate(starts_at):
+        inc = {'count': int(counts[i]), 'sum': float(sums[i]), 'sumsq': float(sumsqs[i])}
+        inc.update({f'band_time.{b}': float(band_time[i, b]) for b in np.flatnonzero(band_time[i])})
+        updates.append(UpdateOne({'patient': patient_id, 'period': period, 'start': start},
+                                 {'$inc': inc, '$min': {'min': float(mins[i])}, '$max': {'max': float(maxs[i])}},
+                                 upsert=True))
+    return updates
+
+
+def total_updates(patient_id, col: str, timestamps: np.ndarray, values: np.ndarray) -> List[UpdateOne]:
+    """
+    Builds the upserts adding basal, bolus or meals to the daily totals
+    """
+    if len(timestamps) == 0:
+        return []
+    starts_at, starts = _buckets(timestamps, 'day')
+    sums = np.add.reduceat(values, starts)
+    return [UpdateOne({'patient': patient_id, 'period': 'day', 'start': start}, {'$inc': {col: float(total)}},
+                      upsert=True) for start, total in zip(starts_at, sums.tolist())]
+
+
+def _write(updates: List[UpdateOne]):
+    if not updates:
+        return
+    try:
+        db.rollups.bulk_write(updates, ordered=False)
+    except BulkWriteError as e:
+        # Two upserts of the same new rollup at once, one of them loses on the unique index and is simply redone
+        retry = [updates[err['index']] for err in e.details['writeErrors'] if err['code'] == 11000]
+        if len(retry) < len(e.details['writeErrors']):
+            raise
+        db.rollups.bulk_write(retry, ordered=False)
+
+
+def _arrays(docs: Iterable[dict]):
+    docs = sorted(docs, key=lambda d: d['timestamp'])
+    timestamps = np.array([d['timestamp'] for d in docs], dtype='datetime64[s]')
+    values = np.array([d['value'] for d in docs], dtype=np.float64)
+    return timestamps, values
+
+
+def record_rollups(patient_id, col: str, docs: List[dict]):
+    """
+    Adds newly stored documents to the rollups of a patient
+    :param patient_id: ObjectId of the patient
+    :param col: The data type
+    :param docs: Documents with 'timestamp' and 'value'
+    """
+    if not docs or (col != 'cgm' and col not in TOTALS):
+        return
+    timestamps, values = _arrays(docs)
+    if col != 'cgm':
+        _write(total_updates(patient_id, col, timestamps, values))
+        return
+
+    first = min(doc['timestamp'] for doc in docs)
+    previous = db.cgm.find_one({'patient': patient_id, 'timestamp': {'$lt': first}}, {'timestamp': 1},
+                               sort=[('timestamp', -1)])
+    previous = None if previous is None else np.datetime64(previous['timestamp'], 's')
+    _write([update for period in PERIODS for update in cgm_updates(patient_id, timestamps, values, previous, period)])
+
+
+def _rebuild_chunk(patient_id, chunk: List[dict], previous: Optional[np.datetime64]) -> np.datetime64:
+    timestamps, values = _arrays(chunk)
+    _write([update for period in PERIODS for update in cgm_updates(patient_id, timestamps, values, previous, period)])
+    return timestamps[-1]
+
+
+def rebuild_rollups(patient_id, chunk_size: int = 50000) -> int:
+    """
+    Rebuilds all rollups of a patient from the raw data
+    :param patient_id: ObjectId of the patient
+    :param chunk_size: Number of readings processed at once
+    :return: Number of rollups
+    """
+    db.rollups.delete_many({'patient': patient_id})
+    # The pieces of a bucket split over two chunks simply add up
+    previous = None
+    chunk = []
+    for doc in db.cgm.find({'patient': patient_id}, {'timestamp': 1, 'value': 1, '_id': 0}).sort('timestamp', ASCENDING):
+        chunk.append(doc)
+        if len(chunk) == chunk_size:
+            previous = _rebuild_chunk(patient_id, chunk, previous)
+            chunk = []
+    if chunk:
+        _rebuild_chunk(patient_id, chunk, previous)
+
+    for col in TOTALS:
+        _write(total_updates(patient_id, col, *_arrays(db[col].find({'patient': patient_id},
+                                                                     {'timestamp': 1, 'value': 1, '_id': 0}))))
+    return db.rollups.count_documents({'patient': patient_id})
+
+
+def get_rollups(patient_id, period: str, start_time: datetime.datetime,
+                end_time: Optional[datetime.datetime] = None) -> List[dict]:
+    """
+    Gets the rollups of a patient for the periods starting in a window, oldest first
+    """
+    return list(db.rollups.find({'patient': patient_id, 'period': period, 'start': time_condition(start_time, end_time)},
+                                {'_id': 0, 'patient': 0, 'period': 0}).sort('start', ASCENDING))
+
+
+def summarize_rollups(rollups: List[dict]) -> dict:
+    """
+    Combines rollups into the summary of their whole window
+    :return: A dict with the 'readings', 'mean', 'sd', 'min', 'max', the fraction of time per glycemic band as
+             'distribution' and the TOTALS. Statistics without readings are None
+    """
+    count = sum(r.get('count', 0) for r in rollups)
+    band_time = np.zeros(BANDS)
+    for r in rollups:
+        for band, seconds in (r.get('band_time') or {}).items():
+            band_time[int(band)] += seconds
+    summary = {'readings': count, 'mean': None, 'sd': None, 'min': None, 'max': None, 'distribution': None}
+    if count:
+        mean = sum(r.get('sum', 0) for r in rollups) / count
+        summary.update(mean=mean, sd=max(sum(r.get('sumsq', 0) for r in rollups) / count - mean * mean, 0) ** 0.5,
+                       min=min(r['min'] for r in rollups if 'min' in r), max=max(r['max'] for r in rollups if 'max' in r))
+        if band_time.sum() > 0:
+            summary['distribution'] = (band_time / band_time.sum()).tolist()
+    summary.update({col: sum(r.get(col, 0) for r in rollups) for col in TOTALS})
+    return summary
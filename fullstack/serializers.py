@@ -0,0 +1,80 @@
+"""
+Author: Alexander
+Description: JSON serializers for responses. All of them produce the same MongoDB extended JSON as
+             bson.json_util.dumps ({"$oid": ...}, {"$date": ...}), but only the bson one walks the whole object
+             through the extended JSON hooks. The others only call them for the values plain JSON can't encode,
+             which makes a big difference for long lists of numbers like cgm series and previews.
+             orjson is optional and used automatically when it's installed.
+"""
+from typing import Callable, Dict, Union
+import json
+
+from bson import json_util
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+
+def _plain(data):
+    # Cursors and other iterables are encoded as lists, like json_util.dumps does
+    if isinstance(data, (dict, list)):
+        return data
+    return list(data)
+
+
+def bson_dumps(data, pretty: bool = False) -> str:
+    if pretty:
+        return json_util.dumps(data, indent=2, separators=(", ", ": "))
+    return json_util.dumps(data, separators=(",", ":"))
+
+
+def json_dumps(data, pretty: bool = False) -> str:
+    if pretty:
+        return json.dumps(_plain(data), default=json_util.default, indent=2, separators=(", ", ": "))
+    return json.dumps(_plain(data), default=json_util.default, separators=(",", ":"))
+
+
+def orjson_dumps(data, pretty: bool = False) -> bytes:
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(_plain(data), default=json_util.default, option=option)
+
+
+SERIALIZERS: Dict[str, Callable] = {'bson': bson_dumps, 'json': json_dumps}
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson_dumps
+
+
+def get_serializer(name: str) -> Callable:
+    """
+    Gets a serializer by name, where 'auto' is the fastest one available
+    """
+    if name == 'auto':
+        return SERIALIZERS.get('orjson') or SERIALIZERS['json']
+    return SERIALIZERS[name]
+
+
+def serialize(data, name: str = 'auto', pretty: bool = False) -> Union[str, bytes]:
+    """
+    Serializes a response payload. Pretty printed payloads are only used for debugging, so they keep the exact
+    formatting of bson.json_util. Payloads the fast encoders can't handle (e.g. integers above 64 bits for orjson)
+    also fall back to bson.json_util
+    :param data: A bson object, or an iterable of them
+    :param name: Name of the serializer, see SERIALIZERS
+    :param pretty: Whether to indent the output
+    :return: The JSON document
+    """
+    if pretty:
+        return bson_dumps(data, pretty)
+    serializer = get_serializer(name)
+    if serializer is bson_dumps:
+        return serializer(data)
+    if not isinstance(data, (dict, list)):
+        data = list(data)
+    try:
+        return serializer(data)
+    except (TypeError, OverflowError, ValueError):
+        return bson_dumps(data)
@@ -0,0 +1,161 @@
+"""
+Author: Alexander
+Description: Fetching of time series data as numpy arrays, for everything that computes on the data rather than
+             just passing it on to the client
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import datetime
+
+import mongomock
+import numpy as np
+from pymongo.errors import OperationFailure
+
+from fullstack import app, db
+from fullstack.analytics import downsample
+
+
+# Exercise from the CSV files and the synthetic data has a 'duration' in seconds and an 'intensity' instead of a
+# 'value', and its intensity is read as the value. mongomock changes projections while using them, so every query
+# gets a copy
+SERIES_PROJECTION = {'value': 1, 'intensity': 1, 'timestamp': 1, '_id': 0}
+VALUE_EXPRESSION = {'$ifNull': ['$value', '$intensity']}
+
+_executor = None
+_executor_lock = Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config["DATA_FETCH_WORKERS"], thread_name_prefix='fetch')
+        return _executor
+
+
+def shutdown():
+    """
+    Waits for running fetches and stops the thread pool, for a graceful shutdown of the server
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def fetch_parallel(fetch: Callable, cols: Iterable[str]) -> Dict:
+    """
+    Runs fetch for every data type on a shared, bounded thread pool, so the queries to the different collections
+    wait for each other's round trips at the same time instead of one after another.
+    With DATA_FETCH_WORKERS set to 1 or less they simply run in order
+    :param fetch: Function taking a data type
+    :param cols: The data types
+    :return: A dict of data type to the result of fetch
+    """
+    cols = list(cols)
+    if app.config["DATA_FETCH_WORKERS"] <= 1 or len(cols) <= 1:
+        return {col: fetch(col) for col in cols}
+    futures = {col: _get_executor().submit(fetch, col) for col in cols}
+    return {col: future.result() for col, future in futures.items()}
+
+
+def supports_aggregation() -> bool:
+    """
+    Whether the database implements the aggregation operators used for computing in the database.
+    mongomock only implements part of them, so there the data is fetched and computed on with numpy instead
+    """
+    return not isinstance(db.client, mongomock.MongoClient)
+
+
+def time_condition(start_time: datetime.datetime, end_time: datetime.datetime = None) -> dict:
+    """
+    Builds the query condition on 'timestamp' for a window, where end_time is optional and exclusive
+    """
+    condition = {'$gte': start_time}
+    if end_time is not None:
+        condition['$lt'] = end_time
+    return condition
+
+
+def get_value(doc: dict) -> Optional[float]:
+    """
+    Gets the value of a stored data point, see SERIES_PROJECTION
+    """
+    return doc['value'] if 'value' in doc else doc.get('intensity')
+
+
+def to_arrays(data: list, fields: Sequence[str] = ()) -> Tuple[np.ndarray, ...]:
+    """
+    Converts documents with 'timestamp' and 'value' to sorted numpy arrays
+    :param fields: Other fields to get arrays of, which are NaN where a document doesn't have them
+    :return: A tuple of (timestamps, values) followed by the arrays of the fields
+    """
+    timestamps = np.fromiter((int(d['timestamp'].timestamp()) for d in data), dtype=np.float64, count=len(data))
+    values = np.fromiter((get_value(d) for d in data), dtype=np.float64, count=len(data))
+    extra = [np.fromiter((d.get(field, np.nan) for d in data), dtype=np.float64, count=len(data)) for field in fields]
+    order = np.argsort(timestamps, kind='stable')
+    return (timestamps[order], values[order], *(array[order] for array in extra))
+
+
+def get_patient_series(patient_id, col: str, start_time: datetime.datetime, end_time: datetime.datetime = None,
+                       fields: Sequence[str] = ()):
+    """
+    Gets a single data type of a patient as sorted numpy arrays instead of a list of dicts
+    :param fields: Other fields to get, see to_arrays
+    :return: A tuple of (timestamps, values) followed by the arrays of the fields
+    """
+    data = list(db[col].find({'patient': patient_id, 'timestamp': time_condition(start_time, end_time)},
+                             dict(SERIES_PROJECTION, **{field: 1 for field in fields})))
+    return to_arrays(data, fields)
+
+
+def get_series_batch(patient_ids: List, col: str, start_time: datetime.datetime,
+                     end_time: datetime.datetime = None) -> Dict:
+    """
+    Gets a single data type for many patients with one query
+    :return: A dict of patient id to a tuple of sorted (timestamps, values). Patients without data are left out
+    """
+    data = db[col].find({'patient': {'$in': list(patient_ids)}, 'timestamp': time_condition(start_time, end_time)},
+                        {'value': 1, 'timestamp': 1, 'patient': 1, '_id': 0})
+    per_patient = {}
+    for d in data:
+        per_patient.setdefault(d['patient'], []).append(d)
+    return {patient: to_arrays(docs) for patient, docs in per_patient.items()}
+
+
+def get_downsampled_series(patient_id, col: str, start_time: datetime.datetime, end_time: datetime.datetime,
+                           resolution: int) -> Dict[str, np.ndarray]:
+    """
+    Gets a single data type of a patient aggregated into buckets of resolution seconds. The buckets are computed in
+    the database where possible
+    :return: A dict of arrays, see analytics.downsample
+    """
+    if supports_aggregation():
+        bucket_ms = resolution * 1000
+        time_ms = {'$toLong': '$timestamp'}
+        try:
+            data = list(db[col].aggregate([
+                {'$match': {'patient': patient_id, 'timestamp': time_condition(start_time, end_time)}},
+                {'$group': {'_id': {'$subtract': [time_ms, {'$mod': [time_ms, bucket_ms]}]},
+                            'v': {'$avg': VALUE_EXPRESSION}, 'min': {'$min': VALUE_EXPRESSION},
+                            'max': {'$max': VALUE_EXPRESSION},
+                            'n': {'$sum': 1}}},
+                {'$sort': {'_id': 1}},
+            ]))
+        except OperationFailure:
+            pass
+        else:
+            # Stored timestamps are naive, so the bucket start is converted back the same way to_arrays does it
+            starts = (datetime.datetime.utcfromtimestamp(d['_id'] / 1000) for d in data)
+            return {
+                't': np.fromiter((int(t.timestamp()) for t in starts), dtype=np.int64, count=len(data)),
+                'v': np.array([d['v'] for d in data], dtype=np.float64),
+                'min': np.array([d['min'] for d in data], dtype=np.float64),
+                'max': np.array([d['max'] for d in data], dtype=np.float64),
+                'n': np.array([d['n'] for d in data], dtype=np.int64),
+            }
+
+    timestamps, values = get_patient_series(patient_id, col, start_time, end_time)
+    return downsample(timestamps, values, resolution)
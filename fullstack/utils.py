@@ -2,33 +2,43 @@
 Author: Alexander
 Description: Common utility functions used across the program
 """
-from typing import Union, List, Optional
-from bson import ObjectId
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Iterable, Union, List, Mapping, Optional
+from bson import ObjectId, decode, encode
 from json import JSONDecodeError
 from fullstack import app, db
-from bson.json_util import dumps, loads
-from flask import request, abort, make_response
+from fullstack.auth import principal_cache, make_principal, PRINCIPAL_FIELDS
+from fullstack.metrics import span
+from fullstack.serializers import serialize
+from bson.json_util import loads
+from flask import request, abort, make_response, stream_with_context
+import datetime
 import jwt
 import time
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 def jsonify(data: Union[list, dict]):
     """
-    A wrapper around bson.dumps for http responses, exactly like flask.jsonify
+    A wrapper around the configured serializer for http responses, exactly like flask.jsonify
     :param data: A bson object
     :return:
     """
-    indent = None
-    separators = (",", ":")
+    pretty = app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug
+    with span('serialize'):
+        body = serialize(data, app.config["JSON_SERIALIZER"], pretty)
+    return app.response_class(body, mimetype=app.config["JSONIFY_MIMETYPE"])
 
-    if app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug:
-        indent = 2
-        separators = (", ", ": ")
 
-    return app.response_class(
-        dumps(data, indent=indent, separators=separators),
-        mimetype=app.config["JSONIFY_MIMETYPE"]
-    )
+def stream_json(chunks: Iterable[str]):
+    """
+    Like jsonify, but for a JSON document that is generated in chunks. The chunks are sent as they are generated
+    :param chunks: Generator of JSON text
+    :return:
+    """
+    return app.response_class(stream_with_context(chunks), mimetype=app.config["JSONIFY_MIMETYPE"])
 
 
 def get_json(filter: dict = None, required: Union[List[str], bool] = None) -> dict:
@@ -64,32 +74,71 @@ def get_json(filter: dict = None, required: Union[List[str], bool] = None) -> di
     return out
 
 
-def get_login() -> dict:
+def get_login() -> Mapping:
     """
-    Gets a user object from an API key in the headers or aborts if invalid
-    :return: User object
+    Gets the principal of the user from an API key in the headers or aborts if invalid.
+    The principal is read-only and shared between requests, see auth.make_principal
+    :return: Principal user object
     """
-    api_key = request.headers.get("api_key")
+    with span('auth'):
+        return _get_principal(request.headers.get("api_key"))
+
+
+def _get_principal(api_key: Optional[str]) -> Mapping:
     if api_key is None:
         error(401, "Invalid API key")
+    data = decode_token(api_key, 'access')
+    user_id = ObjectId(data["id"])
+    if data.get('role') == 'patient':
+        # Patients can only view themselves, so the token has everything there is to know about them
+        return make_principal({'_id': user_id, 'token_version': data['tv']})
+
+    # Doctors and legacy tokens without claims
+    user = principal_cache.get(user_id)
+    if user is None:
+        user = db.users.find_one({'_id': user_id}, PRINCIPAL_FIELDS)
+        if user is None:
+            error(400, "Invalid user")
+        user = make_principal(user)
+        principal_cache.put(user_id, user)
+    if user.get('token_version', 0) != data.get('tv', 0):
+        error(401, "API key revoked")
+    return user
+
+
+def decode_token(token: str, token_type: str) -> dict:
+    """
+    Decodes and verifies a token or aborts if invalid. Legacy API keys without a type count as access tokens
+    :param token: The token
+    :param token_type: 'access' or 'refresh'
+    :return: The claims of the token
+    """
     try:
-        data = jwt.decode(api_key, key=app.config["SECRET_KEY"], algorithms=["HS256"])
+        data = jwt.decode(token, key=app.config["SECRET_KEY"], algorithms=["HS256"])
+    except jwt.exceptions.ExpiredSignatureError:
+        error(401, "API key expired")
     except (jwt.exceptions.DecodeError, jwt.exceptions.InvalidSignatureError, jwt.exceptions.InvalidAlgorithmError):
         error(400, "Invalid API key")
-    else:
-        user = db.users.find_one({'_id': ObjectId(data["id"])})
-        if user is None:
-            error(400, "Invalid user")
-        return user
+    if data.get('typ', 'access') != token_type or 'id' not in data:
+        error(400, "Invalid API key")
+    return data
 
 
-def create_api_key(user_id: ObjectId) -> str:
+def create_tokens(user: Mapping) -> dict:
     """
-    Creates an API key from a user id
-    :param user_id: User ObjectId
-    :return: API key string
+    Creates a short-lived access token, which is the API key, and a refresh token to get a new one with.
+    Both hold the token version of the user, so increasing it revokes them. The access token also holds the role
+    :param user: User object with '_id', and 'is_doctor' and 'token_version' if set
+    :return: A dict with the 'api_key', 'refresh_token' and the seconds the API key 'expires_in'
     """
-    return jwt.encode({'id': str(user_id), 'timestamp': int(time.time())}, key=app.config["SECRET_KEY"], algorithm="HS256")
+    now = int(time.time())
+    claims = {'id': str(user['_id']), 'tv': user.get('token_version', 0), 'iat': now}
+    access = dict(claims, typ='access', role='doctor' if user.get('is_doctor') else 'patient',
+                  exp=now + app.config["ACCESS_TOKEN_TTL"])
+    refresh = dict(claims, typ='refresh', exp=now + app.config["REFRESH_TOKEN_TTL"])
+    return {'api_key': jwt.encode(access, key=app.config["SECRET_KEY"], algorithm="HS256"),
+            'refresh_token': jwt.encode(refresh, key=app.config["SECRET_KEY"], algorithm="HS256"),
+            'expires_in': app.config["ACCESS_TOKEN_TTL"]}
 
 
 def error(error_code: int, message: str):
@@ -103,22 +152,80 @@ def error(error_code: int, message: str):
     abort(response)
 
 
-def check_viewable(me, id: Optional[Union[str, ObjectId]]) -> ObjectId:
+def check_viewable(me: Mapping, id: Optional[Union[str, ObjectId]]) -> ObjectId:
     """
     Gets the id if it's viewable to the user, otherwise it aborts.
-    :param me: The user object of the current user
+    :param me: The principal of the current user
     :param id: The id of the user to be viewed as a str or ObjectId, or None if viewing self
     :return: An ObjectId of the user to be viewed
     """
     if id is None:
         return me.get('_id')
-    patient_id = ObjectId(id) if isinstance(id, str) else id
+    patient_id = get_objectid(id) if isinstance(id, str) else id
 
-    viewable = me.get("viewable") or []
-    viewable.append(me.get('_id'))
-    if ObjectId(patient_id) not in viewable:
+    if patient_id not in me['can_view']:
         error(403, 'Not allowed to view this user')
-    return ObjectId(patient_id)
+    return patient_id
+
+
+def get_since() -> Optional[datetime.datetime]:
+    """
+    Gets the optional 'since' query parameter, in seconds since epoch, or aborts if invalid
+    :return: The time as a naive local datetime like the stored timestamps, or None
+    """
+    since = request.args.get('since')
+    if since is None:
+        return None
+    try:
+        return datetime.datetime.fromtimestamp(float(since))
+    except (ValueError, OverflowError, OSError):
+        error(400, 'Invalid since')
+
+
+def paginate(collection, query: dict, fields: Mapping[str, int], keys: List[str]):
+    """
+    Finds documents one page at a time, by the keys rather than by skipping, so every page is as cheap as the first.
+    Reads the query parameters 'limit' (at most MAX_PAGE_SIZE), 'cursor' and 'fields', a comma separated subset of
+    the fields. When there are more documents, the cursor of the next page is sent in the X-Next-Cursor header
+    :param collection: The collection
+    :param query: Filter of the documents
+    :param fields: The fields that may be shown, as a projection
+    :param keys: The fields to sort on, unique together, like ['timestamp', '_id']
+    :return: A response with the page as a list
+    """
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        error(400, 'Invalid limit')
+
+    projection = dict(fields)
+    if 'fields' in request.args:
+        requested = request.args['fields'].split(',')
+        if any(field not in fields for field in requested):
+            error(400, 'Invalid fields')
+        projection = {field: 1 for field in requested}
+    hidden = [key for key in keys if key != '_id' and key not in projection]
+    projection.update({key: 1 for key in hidden})
+
+    if 'cursor' in request.args:
+        try:
+            values = decode(urlsafe_b64decode(request.args['cursor'].encode()))['k']
+        except Exception:
+            error(400, 'Invalid cursor')
+        if not isinstance(values, list) or len(values) != len(keys):
+            error(400, 'Invalid cursor')
+        # Everything after the cursor: a greater first key, or the same first key and a greater second key, etc.
+        after = [dict({k: v for k, v in zip(keys[:i], values)}, **{keys[i]: {'$gt': values[i]}}) for i in range(len(keys))]
+        query = {'$and': [query, {'$or': after}]}
+
+    docs = list(collection.find(query, projection).sort([(key, 1) for key in keys]).limit(limit + 1))
+    response = jsonify([{k: v for k, v in doc.items() if k not in hidden} for doc in docs[:limit]])
+    if len(docs) > limit:
+        last = docs[limit - 1]
+        response.headers['X-Next-Cursor'] = urlsafe_b64encode(encode({'k': [last.get(key) for key in keys]})).decode()
+    return response
 
 
 def get_objectid(id: str) -> ObjectId:
@@ -2,3 +2,4 @@ from fullstack.views.user import UserView
 from fullstack.views.data import DataView
 from fullstack.views.diagnosis import DiagnosisView
 from fullstack.views.note import NoteView
+from fullstack.views.metrics import MetricsView
@@ -4,17 +4,43 @@ Description: Data endpoint, for operations on diagnoses
              Generally this is for basal, bolus, cgm, exercise and meals,
              but there's also an endpoint for updating "extra" single-time data.
 """
-from typing import Optional
+from typing import Iterator, List, Optional, Tuple
+import json
 
-from fullstack import db, DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS
+from pymongo.errors import BulkWriteError
 
+from fullstack import app, db, DEFAULT_GLYCEMIC_RANGES
+from fullstack.analytics import COHORT_METRICS, glycemic_metrics
+from fullstack.cohort import get_cohort_metrics, rank
+from fullstack.auth import principal_cache
+
+from flask import request
 from flask_classy import FlaskView, route
-from fullstack.utils import jsonify, get_json, get_login, error, check_viewable
+from fullstack.previews import load_previews, record_readings
+from fullstack.rollups import PERIODS, get_rollups, record_rollups, summarize_rollups
+from fullstack.metrics import span
+from fullstack.formats import FORMATS, BINARY_MIMETYPE, encode_binary, encode_columnar
+from fullstack.series import SERIES_PROJECTION, fetch_parallel, get_downsampled_series, get_patient_series, get_value, \
+    time_condition
+from fullstack.utils import jsonify, stream_json, get_json, get_login, error, check_viewable
 import datetime
+import math
 
 
 ALL_TYPES = ['basal', 'bolus', 'cgm', 'exercise', 'meals']
-NDAYS = 14
+STREAM_BATCH_SIZE = 1000
+MAX_COHORT_PAGE = 1000
+RECORD_PROJECTION = dict(SERIES_PROJECTION, duration=1)
+
+
+def to_record(doc: dict) -> dict:
+    """
+    Converts a stored data point to {'t': timestamp, 'v': value}, with the duration in seconds as 'd' for exercise
+    """
+    record = {'t': int(doc['timestamp'].timestamp()), 'v': get_value(doc)}
+    if 'duration' in doc:
+        record['d'] = doc['duration']
+    return record
 
 
 def parse_data_types(show):
@@ -27,40 +53,216 @@ def parse_data_types(show):
     return list(out)
 
 
-def check_distributions(dist, perc):
-    out = []
-    if dist[0] > perc[0]:
-        out.append(0)
-    if dist[0] + dist[1] > perc[1]:
-        out.append(1)
-    if dist[2] < perc[2]:
-        out.append(2)
-    if dist[3] + dist[4] > perc[3]:
-        out.append(3)
-    if dist[4] > perc[4]:
-        out.append(4)
-    return out
-
-
-def get_patient_data(patient_id, show: list, start_time: datetime.datetime, end_time: datetime.datetime = None):
-
-    condition = {'$gte': start_time}
-    if end_time is not None:
-        condition['$lt'] = end_time
-
-    out = {}
-    for col in show:
-        data = db[col].find({'patient': patient_id, 'timestamp': condition},
-                            {'value': 1, 'timestamp': 1, '_id': 0})
-        out[col] = [{'t': int(d['timestamp'].timestamp()), 'v': d['value']} for d in data]
-    return out
-
-
-def get_range_idx(ranges: list, val: float):
-    for i in range(len(ranges)):
-        if val < ranges[i]:
-            return i
-    return len(ranges)
+def get_patient_data(patient_id, show: list, start_time: datetime.datetime, end_time: datetime.datetime = None,
+                     resolution: int = None):
+    """
+    Gets the data of a patient as a list of {'t': timestamp, 'v': value} per data type. With a resolution, the data is
+    aggregated into buckets of that many seconds, and every bucket also has 'min', 'max' and the number of readings 'n'.
+    The data types are fetched concurrently
+    """
+    def fetch(col):
+        if resolution is not None:
+            d = get_downsampled_series(patient_id, col, start_time, end_time, resolution)
+            return [{'t': t, 'v': v, 'min': lo, 'max': hi, 'n': n} for t, v, lo, hi, n in
+                    zip(d['t'].tolist(), d['v'].tolist(), d['min'].tolist(), d['max'].tolist(), d['n'].tolist())]
+        data = db[col].find({'patient': patient_id, 'timestamp': time_condition(start_time, end_time)},
+                            dict(RECORD_PROJECTION))
+        return [to_record(d) for d in data]
+
+    return fetch_parallel(fetch, show)
+
+
+def stream_patient_data(patient_id, show: list, start_time: datetime.datetime, end_time: datetime.datetime = None,
+                        batch_size: int = STREAM_BATCH_SIZE) -> Iterator[str]:
+    """
+    Same as get_patient_data, but generates the JSON document in chunks of batch_size readings while iterating
+    the cursors, so nothing more than a single batch is ever held in memory
+    :return: Generator of JSON chunks
+    """
+    yield '{'
+    for n, col in enumerate(show):
+        yield ('' if n == 0 else ',') + json.dumps(col) + ':['
+        data = db[col].find({'patient': patient_id, 'timestamp': time_condition(start_time, end_time)},
+                            dict(RECORD_PROJECTION), batch_size=batch_size)
+        prefix = ''
+        batch = []
+        for d in data:
+            batch.append(to_record(d))
+            if len(batch) == batch_size:
+                yield prefix + json.dumps(batch, separators=(',', ':'))[1:-1]
+                prefix = ','
+                batch = []
+        if batch:
+            yield prefix + json.dumps(batch, separators=(',', ':'))[1:-1]
+        yield ']'
+    yield '}'
+
+
+def get_patient_updates(patient_id, show: list, marks: dict, start_time: datetime.datetime = None,
+                        end_time: datetime.datetime = None) -> dict:
+    """
+    Gets the data of a patient that is newer than the high-water mark of every data type, so polling only reads the
+    new readings. Data types without a mark get the data of the window instead
+    :param marks: A dict of data type to the timestamp of the last reading seen, in seconds since epoch
+    :return: A dict with the readings per data type as in get_patient_data in 'data', and the new marks in 'since'
+    """
+    def fetch(col):
+        if col in marks:
+            condition = {'$gt': datetime.datetime.fromtimestamp(marks[col])}
+        else:
+            condition = time_condition(start_time, end_time)
+        data = list(db[col].find({'patient': patient_id, 'timestamp': condition}, dict(RECORD_PROJECTION)))
+        # The mark keeps the exact timestamp, which the whole seconds of 't' don't
+        mark = max(d['timestamp'] for d in data).timestamp() if data else marks.get(col)
+        return [to_record(d) for d in data], mark
+
+    fetched = fetch_parallel(fetch, show)
+    return {'data': {col: data for col, (data, _) in fetched.items()},
+            'since': {col: mark for col, (_, mark) in fetched.items()}}
+
+
+def parse_marks(since: dict) -> dict:
+    """
+    Gets the high-water marks of a sync request, where a mark of None is the same as no mark
+    """
+    marks = {}
+    for col, mark in since.items():
+        if mark is None:
+            continue
+        if col not in ALL_TYPES or isinstance(mark, bool) or not isinstance(mark, (int, float)):
+            error(400, 'Invalid since')
+        try:
+            datetime.datetime.fromtimestamp(mark)
+        except (OverflowError, OSError, ValueError):
+            error(400, 'Invalid since')
+        marks[col] = mark
+    return marks
+
+
+def parse_window(inp: dict) -> Tuple[datetime.datetime, Optional[datetime.datetime]]:
+    """
+    Gets the time window of a request, from either 'ndays' or 'start_time' and an optional 'end_time' (inclusive)
+    :param inp: The parsed input
+    :return: A tuple of start time and exclusive end time, which is None for a window up to now
+    """
+    end_time = None
+    if 'ndays' in inp:
+        start_time = datetime.datetime.now() - datetime.timedelta(days=inp['ndays'])
+    else:
+        if 'start_time' in inp:
+            try:
+                start_time = datetime.datetime.strptime(inp['start_time'], "%Y-%m-%d")
+            except ValueError:
+                error(400, 'Invalid start time')
+        else:
+            error(400, "Missing 'start_time' or 'ndays' parameter")
+
+        if 'end_time' in inp:
+            try:
+                end_time = datetime.datetime.strptime(inp['end_time'], "%Y-%m-%d")
+            except ValueError:
+                error(400, 'Invalid end time')
+            end_time += datetime.timedelta(days=1)
+    return start_time, end_time
+
+
+def parse_point(data_type, value, timestamp) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Validates a single data point
+    :return: A tuple of the document to insert and None, or None and an error message
+    """
+    if data_type not in ALL_TYPES:
+        return None, 'Invalid data type'
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None, 'Invalid value'
+    if isinstance(timestamp, bool) or not isinstance(timestamp, int):
+        return None, 'Invalid timestamp'
+    try:
+        t = datetime.datetime.fromtimestamp(timestamp)
+    except (OverflowError, OSError, ValueError):
+        return None, 'Invalid timestamp'
+    return {'timestamp': t, 'value': float(value)}, None
+
+
+def parse_batch() -> Tuple[dict, list]:
+    """
+    Parses a batch of data points from the request body. The body can be
+     - NDJSON (Content-Type application/x-ndjson) with one {type, value, timestamp} object per line
+     - A JSON list of {type, value, timestamp} objects, or an object with such a list under "points"
+     - A columnar JSON object of {type: {"t": [timestamps], "v": [values]}}, which can be combined with "points"
+    :return: A dict of data type to (item reference, document) pairs and a list of errors
+    """
+    grouped = {col: [] for col in ALL_TYPES}
+    errors = []
+    points = []
+
+    if request.mimetype == 'application/x-ndjson':
+        for i, line in enumerate(request.get_data(as_text=True).splitlines()):
+            if not line.strip():
+                continue
+            try:
+                points.append((i, json.loads(line)))
+            except ValueError:
+                errors.append({'index': i, 'error': 'Invalid JSON'})
+    else:
+        try:
+            body = json.loads(request.data)
+        except ValueError:
+            error(400, 'Invalid input')
+        if isinstance(body, dict):
+            columns = {key: body[key] for key in body if key in ALL_TYPES}
+            body = body.get('points') or []
+        else:
+            columns = {}
+        if not isinstance(body, list):
+            error(400, 'Invalid input')
+        points = list(enumerate(body))
+
+        for col, column in columns.items():
+            if not isinstance(column, dict) or not isinstance(column.get('t'), list) \
+                    or not isinstance(column.get('v'), list) or len(column['t']) != len(column['v']):
+                error(400, f'Invalid {col} columns')
+            for i, (timestamp, value) in enumerate(zip(column['t'], column['v'])):
+                doc, message = parse_point(col, value, timestamp)
+                if message is None:
+                    grouped[col].append(({'type': col, 'index': i}, doc))
+                else:
+                    errors.append({'type': col, 'index': i, 'error': message})
+
+    for i, point in points:
+        if not isinstance(point, dict):
+            errors.append({'index': i, 'error': 'Invalid input'})
+            continue
+        doc, message = parse_point(point.get('type'), point.get('value'), point.get('timestamp'))
+        if message is None:
+            grouped[point['type']].append(({'index': i}, doc))
+        else:
+            errors.append({'index': i, 'error': message})
+    return grouped, errors
+
+
+def store_data(patient_id, col: str, docs: List[dict]) -> List[Tuple[int, str]]:
+    """
+    Inserts documents of a single data type for a patient and updates everything derived from the data
+    :param patient_id: ObjectId of the patient
+    :param col: The data type
+    :param docs: Documents with 'timestamp' and 'value'
+    :return: A list of (index, message) for the documents that couldn't be inserted
+    """
+    for doc in docs:
+        doc['patient'] = patient_id
+    errors = []
+    try:
+        db[col].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = [(err['index'], err['errmsg']) for err in e.details['writeErrors']]
+
+    failed = {index for index, _ in errors}
+    inserted = [doc for i, doc in enumerate(docs) if i not in failed]
+    if col == 'cgm':
+        record_readings(patient_id, [doc['timestamp'] for doc in inserted], [doc['value'] for doc in inserted])
+    record_rollups(patient_id, col, inserted)
+    return errors
 
 
 class DataView(FlaskView):
@@ -71,30 +273,59 @@ class DataView(FlaskView):
         me = get_login()
         patient_id = check_viewable(me, id_str)
 
-        inp = get_json({'start_time': str, 'end_time': str, 'ndays': int, 'show': list})
+        inp = get_json({'start_time': str, 'end_time': str, 'ndays': int, 'show': list, 'stream': bool,
+                        'format': str, 'resolution': int, 'max_points': int, 'since': dict})
         show = parse_data_types(inp.get('show'))
 
-        start_time = None
-        end_time = None
-        if 'ndays' in inp:
-            start_time = datetime.datetime.now() - datetime.timedelta(days=inp['ndays'])
-        else:
-            if 'start_time' in inp:
-                try:
-                    start_time = datetime.datetime.strptime(inp['start_time'], "%Y-%m-%d")
-                except ValueError:
-                    error(400, 'Invalid start time')
+        data_format = inp.get('format')
+        if data_format is None:
+            best = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE])
+            data_format = 'binary' if best == BINARY_MIMETYPE else 'records'
+        if data_format not in FORMATS:
+            error(400, 'Invalid format')
+        if inp.get('stream') and data_format != 'records':
+            error(400, 'Only the records format can be streamed')
+
+        if 'since' in inp:
+            if data_format != 'records' or inp.get('stream') or 'resolution' in inp or 'max_points' in inp:
+                error(400, 'Only the records format can be synced')
+            marks = parse_marks(inp['since'])
+            start_time, end_time = None, None
+            if any(col not in marks for col in show):
+                start_time, end_time = parse_window(inp)
+            return jsonify(get_patient_updates(patient_id, show, marks, start_time, end_time))
+
+        start_time, end_time = parse_window(inp)
+
+        resolution = inp.get('resolution')
+        if 'max_points' in inp:
+            if inp['max_points'] <= 0:
+                error(400, 'Invalid max_points')
+            window = ((end_time or datetime.datetime.now()) - start_time).total_seconds()
+            resolution = max(math.ceil(window / inp['max_points']), 1)
+        if resolution is not None:
+            if resolution <= 0:
+                error(400, 'Invalid resolution')
+            if inp.get('stream'):
+                error(400, 'Downsampled data can not be streamed')
+
+        if data_format != 'records':
+            if resolution is None:
+                series = fetch_parallel(lambda col: get_patient_series(patient_id, col, start_time, end_time,
+                                                                       ['duration'] if col == 'exercise' else []), show)
             else:
-                error(400, "Missing 'start_time' or 'ndays' parameter")
-
-            if 'end_time' in inp:
-                try:
-                    end_time = datetime.datetime.strptime(inp['start_time'], "%Y-%m-%d")
-                except ValueError:
-                    error(400, 'Invalid start time')
-                end_time += datetime.timedelta(days=1)
-
-        return jsonify(get_patient_data(patient_id, show, start_time, end_time))
+                series = {col: (downsampled['t'], downsampled['v']) for col, downsampled in fetch_parallel(
+                    lambda col: get_downsampled_series(patient_id, col, start_time, end_time, resolution), show).items()}
+            if data_format == 'binary':
+                with span('serialize'):
+                    body = encode_binary(series)
+                return app.response_class(body, mimetype=BINARY_MIMETYPE)
+            with span('compute'):
+                encoded = encode_columnar(series)
+            return jsonify(encoded)
+        if inp.get('stream'):
+            return stream_json(stream_patient_data(patient_id, show, start_time, end_time))
+        return jsonify(get_patient_data(patient_id, show, start_time, end_time, resolution))
 
     @route("/", methods=["POST"])
     def add_data(self):
@@ -109,57 +340,89 @@ class DataView(FlaskView):
         if inp["type"] not in ALL_TYPES:
             error(400, 'Invalid data type')
 
-        db[inp["type"]].insert_one({'timestamp': t, 'patient': me.get("_id"), 'value': inp["value"]})
+        if store_data(me.get("_id"), inp["type"], [{'timestamp': t, 'value': inp["value"]}]):
+            error(500, 'Could not add data')
         return jsonify({'message': 'Added data'})
 
+    @route("/batch", methods=["POST"])
+    def add_data_batch(self):
+        me = get_login()
+        if me.get('is_doctor'):
+            error(403, 'Only patients can upload data')
+
+        grouped, errors = parse_batch()
+        inserted = 0
+        for col, items in grouped.items():
+            if not items:
+                continue
+            failed = store_data(me.get("_id"), col, [doc for _, doc in items])
+            for index, message in failed:
+                errors.append(dict(items[index][0], error=message))
+            inserted += len(items) - len(failed)
+        return jsonify({'message': 'Added data', 'inserted': inserted, 'errors': errors})
+
+    @route('/metrics', methods=["POST"])
+    @route('/<string:id_str>/metrics', methods=["POST"])
+    def get_metrics(self, id_str: Optional[str] = None):
+        me = get_login()
+        patient_id = check_viewable(me, id_str)
+        start_time, end_time = parse_window(get_json({'start_time': str, 'end_time': str, 'ndays': int}))
+
+        timestamps, values = get_patient_series(patient_id, 'cgm', start_time, end_time)
+        with span('compute'):
+            metrics = glycemic_metrics(timestamps, values, DEFAULT_GLYCEMIC_RANGES)
+        return jsonify(metrics)
+
+    @route('/rollups', methods=["POST"])
+    @route('/<string:id_str>/rollups', methods=["POST"])
+    def get_rollups(self, id_str: Optional[str] = None):
+        me = get_login()
+        patient_id = check_viewable(me, id_str)
+        inp = get_json({'start_time': str, 'end_time': str, 'ndays': int, 'period': str})
+        start_time, end_time = parse_window(inp)
+        period = inp.get('period', 'day')
+        if period not in PERIODS:
+            error(400, 'Invalid period')
+
+        rollups = get_rollups(patient_id, period, start_time, end_time)
+        for rollup in rollups:
+            rollup['start'] = int(rollup['start'].timestamp())
+        return jsonify({'summary': summarize_rollups(rollups), 'rollups': rollups})
+
+    @route('/cohort', methods=["POST"])
+    def get_cohort(self):
+        me = get_login()
+        if not me.get('is_doctor'):
+            error(403, 'Only doctors can view cohorts')
+        inp = get_json({'start_time': str, 'end_time': str, 'ndays': int, 'sort': str, 'order': str, 'offset': int,
+                        'limit': int})
+        start_time, end_time = parse_window(inp)
+        sort = inp.get('sort', 'tbr')
+        if sort not in COHORT_METRICS:
+            error(400, 'Invalid sort')
+        if inp.get('order', 'desc') not in ('asc', 'desc'):
+            error(400, 'Invalid order')
+        offset = inp.get('offset', 0)
+        limit = inp.get('limit', 50)
+        if offset < 0 or not 0 < limit <= MAX_COHORT_PAGE:
+            error(400, 'Invalid offset or limit')
+
+        patients = list(db.users.find({'_id': {'$in': list(me['can_view'])}, 'is_doctor': {'$ne': True}},
+                                      {'first_name': 1, 'last_name': 1}))
+        with span('compute'):
+            metrics = get_cohort_metrics([patient['_id'] for patient in patients], start_time, end_time)
+            page = rank(metrics, sort, inp.get('order', 'desc') == 'desc', offset, limit)
+        return jsonify({'total': len(patients), 'patients': [dict(patients[i], **row) for i, row in page]})
+
     @route("/previews", methods=["GET"])
     def get_previews(self):
         me = get_login()
 
-        viewable = me.get("viewable") or []
-        viewable.append(me.get('_id'))
-        users = db.users.find({'_id': {'$in': viewable}, 'is_doctor': {'$ne': True}}, {'_id': 1, 'ranges': 1})
-        show = ['cgm']
-        start_time = datetime.datetime.now() - datetime.timedelta(days=NDAYS)
-
-        # Delete outdated cache
-        db.cache.delete_many({'ttl': {'$lt': datetime.datetime.now()}})
-
-        out = []
-        for patient in users:
-            cache = db.cache.find_one({'patient': patient['_id']})
-            if cache is None:
-                ranges = patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES
-                data = get_patient_data(patient['_id'], show, start_time)
-                values = [0]*96
-                counts = [0]*96
-                dist = [0] * (len(ranges) + 1)
-                curr_time = start_time.timestamp()
-                end_time = data['cgm'][-1]['t']
-                total_time = end_time - curr_time
-                for d in data['cgm']:
-                    # Calculate distribution
-                    dt = d['t'] - curr_time
-                    dist[get_range_idx(ranges, d['v'])] += dt/total_time
-                    curr_time = d['t']
-
-                    # Calculate means
-                    t = datetime.datetime.fromtimestamp(d['t'])
-                    idx = t.hour * 4 + t.minute // 15
-                    values[idx] += d['v']
-                    counts[idx] += 1
-                for i in range(96):
-                    try:
-                        values[i] /= counts[i]
-                    except ZeroDivisionError:
-                        values[i] = None
-                problems = check_distributions(dist, patient.get('glycemic_targets') or DEFAULT_GLYCEMIC_TARGETS)
-                cache = {'patient': patient['_id'], 'values': values, 'distribution': dist, 'problems': problems,
-                         'ttl': datetime.datetime.now() + datetime.timedelta(hours=12)}
-                db.cache.insert_one(cache)
-            out.append(cache)
-
-        return jsonify(out)
+        users = list(db.users.find({'_id': {'$in': list(me['can_view'])}, 'is_doctor': {'$ne': True}},
+                                   {'_id': 1, 'glycemic_ranges': 1, 'glycemic_targets': 1, 'settings_version': 1}))
+        with span('compute'):
+            previews = load_previews(users)
+        return jsonify(previews)
 
     @route('/extra', methods=["PUT"])
     def put_extra(self):
@@ -169,8 +432,6 @@ class DataView(FlaskView):
             if not isinstance(i, int) and not isinstance(i, float):
                 error(400, 'Invalid input')
         data['timestamp'] = datetime.datetime.now()
-        out = me.get('extra_data') or {}
-        for i in data:
-            out[i] = data[i]
-        db.users.update_one({'_id': me.get('_id')}, {'$set':{'extra_data': out}})
+        db.users.update_one({'_id': me.get('_id')}, {'$set': {f'extra_data.{key}': data[key] for key in data}})
+        principal_cache.invalidate(me.get('_id'))
         return jsonify({'message': 'Updated extra data'})
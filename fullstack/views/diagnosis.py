@@ -3,11 +3,14 @@ Author: Alexander
 Description: Diagnosis endpoint, for operations on diagnoses
 """
 from typing import Optional
+import datetime
+
+from bson import ObjectId
 
 from fullstack import db
 
 from flask_classy import FlaskView, route
-from fullstack.utils import jsonify, get_json, get_login, error, check_viewable, get_objectid
+from fullstack.utils import get_json, get_login, error, check_viewable, get_objectid, get_since, paginate
 
 
 class DiagnosisView(FlaskView):
@@ -18,7 +21,12 @@ class DiagnosisView(FlaskView):
         me = get_login()
         patient_id = check_viewable(me, id_str)
 
-        return jsonify(db.diagnosis.find({'patient': patient_id}, {'name': 1, 'medicine': 1}))
+        query = {'patient': patient_id}
+        since = get_since()
+        if since is not None:
+            # Diagnoses are paged by id, which starts with the time the diagnosis was added
+            query['_id'] = {'$gt': ObjectId.from_datetime(since.astimezone(datetime.timezone.utc))}
+        return paginate(db.diagnosis, query, {'name': 1, 'medicine': 1, 'timestamp': 1}, ['_id'])
 
     @route("/<string:id_str>/", methods=["POST"])
     def post_diagnosis(self, id_str: str):
@@ -32,7 +40,8 @@ class DiagnosisView(FlaskView):
             if not isinstance(med, str):
                 error(400, 'Invalid input')
 
-        db.diagnosis.insert_one({'name': inp['name'], 'medicine': inp['medicine'], 'patient': patient_id})
+        db.diagnosis.insert_one({'name': inp['name'], 'medicine': inp['medicine'], 'timestamp': datetime.datetime.now(),
+                                 'patient': patient_id})
         return {'message': 'Added diagnosis'}
 
     @route("/<string:diagnosis_id>/", methods=["PUT"])
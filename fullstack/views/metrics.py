@@ -0,0 +1,23 @@
+"""
+Author: Alexander
+Description: Metrics endpoint, for the request timing histograms and cache statistics
+"""
+from fullstack.auth import principal_cache
+from fullstack.metrics import registry
+from fullstack import passwords
+
+from flask_classy import FlaskView, route
+from fullstack.utils import jsonify, get_login, error
+
+
+class MetricsView(FlaskView):
+
+    @route('/', methods=["GET"])
+    def get_metrics(self):
+        me = get_login()
+        if not me.get("is_doctor"):
+            error(403, 'Only doctors can view metrics')
+        metrics = registry.to_dict()
+        metrics['principal_cache'] = principal_cache.stats()
+        metrics['password_hashing'] = passwords.stats()
+        return jsonify(metrics)
@@ -8,7 +8,7 @@ from typing import Optional
 from fullstack import db
 
 from flask_classy import FlaskView, route
-from fullstack.utils import jsonify, get_json, get_login, error, check_viewable, get_objectid
+from fullstack.utils import get_json, get_login, error, check_viewable, get_objectid, get_since, paginate
 
 
 class NoteView(FlaskView):
@@ -19,10 +19,15 @@ class NoteView(FlaskView):
         me = get_login()
         patient_id = check_viewable(me, id_str)
 
+        query = {'patient': patient_id}
+        since = get_since()
+        if since is not None:
+            query['timestamp'] = {'$gt': since}
         if me.get("is_doctor"):
-            return jsonify(db.note.find({'patient': patient_id}, {'text': 1, 'timestamp': 1, 'writer': 1, 'private': 1}))
+            return paginate(db.note, query, {'text': 1, 'timestamp': 1, 'writer': 1, 'private': 1}, ['timestamp', '_id'])
         else:
-            return jsonify(db.note.find({'patient': patient_id, 'private': {'$ne': True}}, {'text': 1, 'timestamp': 1, 'writer': 1}))
+            query['private'] = {'$ne': True}
+            return paginate(db.note, query, {'text': 1, 'timestamp': 1, 'writer': 1}, ['timestamp', '_id'])
 
     @route('/', methods=["POST"])
     @route("/<string:id_str>/", methods=["POST"])
@@ -13,11 +13,12 @@ from pymongo.collation import Collation
 from pymongo.errors import DuplicateKeyError
 
 from fullstack import db, DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS
+from fullstack.auth import principal_cache
+from fullstack.passwords import HashQueueFull, check_password, hash_password, needs_rehash
 
 from flask import request
 from flask_classy import FlaskView, route
-from fullstack.utils import jsonify, get_json, create_api_key, get_login, error, check_viewable, get_objectid
-import bcrypt
+from fullstack.utils import jsonify, get_json, create_tokens, decode_token, get_login, error, check_viewable, get_objectid
 
 
 def calculate_age(born):
@@ -29,9 +30,7 @@ class UserView(FlaskView):
     @route('/', methods=["GET"])
     def get_users(self):
         me = get_login()
-        viewable = me.get("viewable") or []
-        viewable.append(me.get('_id'))
-        users = db.users.find({'_id': {'$in': viewable}, 'is_doctor': {'$ne': True}}, {'first_name': 1, 'last_name': 1,
+        users = db.users.find({'_id': {'$in': list(me['can_view'])}, 'is_doctor': {'$ne': True}}, {'first_name': 1, 'last_name': 1,
                                                                                        'birthdate': 1, 'email': 1,
                                                                                        'glycemic_ranges': 1, 'glycemic_targets': 1,
                                                                                        'extra_data': 1,
@@ -81,7 +80,10 @@ class UserView(FlaskView):
         data = get_json({'email': str, 'first_name': str, 'last_name': str, 'password': str, 'password_check': str, 'birthdate': str}, required=True)
         if data['password'] != data['password_check']:
             error(400, 'Password does not match check')
-        password_hash = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()).decode()
+        try:
+            password_hash = hash_password(data['password'])
+        except HashQueueFull:
+            error(503, 'Too many requests, try again later')
 
         try:
             data['birthdate'] = datetime.datetime.strptime(data['birthdate'], "%Y-%m-%d")
@@ -158,6 +160,7 @@ class UserView(FlaskView):
             error(400, 'Email already in use')
         except InvalidId:
             error(400, 'Invalid id')
+        principal_cache.invalidate(get_objectid(id))
         return jsonify({'message': 'Updated user'})
 
     @route('/login', methods=["POST"])
@@ -168,11 +171,35 @@ class UserView(FlaskView):
         if user is None:
             error(401, 'Invalid login')
 
-        if bcrypt.checkpw(data['password'].encode('utf-8'), user["password_hash"].encode()):
-            api_key = create_api_key(user["_id"])
-            return jsonify({"api_key": api_key})
-        else:
-            error(401, 'Invalid login')
+        try:
+            if not check_password(data['password'], user["password_hash"]):
+                error(401, 'Invalid login')
+        except HashQueueFull:
+            error(503, 'Too many logins, try again later')
+        if needs_rehash(user["password_hash"]):
+            try:
+                db.users.update_one({'_id': user["_id"], 'password_hash': user["password_hash"]},
+                                    {'$set': {'password_hash': hash_password(data['password'])}})
+            except HashQueueFull:
+                # The password is correct, the rehash simply waits for a later login
+                pass
+        return jsonify(create_tokens(user))
+
+    @route('/refresh', methods=["POST"])
+    def refresh_login(self):
+        data = get_json({'refresh_token': str}, required=True)
+        claims = decode_token(data['refresh_token'], 'refresh')
+        user = db.users.find_one({'_id': get_objectid(claims['id'])}, {'is_doctor': 1, 'token_version': 1})
+        if user is None or user.get('token_version', 0) != claims['tv']:
+            error(401, 'Refresh token revoked')
+        return jsonify(create_tokens(user))
+
+    @route('/logout', methods=["POST"])
+    def logout_user(self):
+        me = get_login()
+        db.users.update_one({'_id': me['_id']}, {'$inc': {'token_version': 1}})
+        principal_cache.invalidate(me['_id'])
+        return jsonify({'message': 'Logged out everywhere'})
 
     @route('/glycemic/<string:id_str>', methods=["PUT"])
     def put_glycemic_parameters(self, id_str):
@@ -198,5 +225,16 @@ class UserView(FlaskView):
                 if not isinstance(i, float) or i < 0 or i > 1:
                     error(400, 'Invalid glycemic targets')
 
-        db.users.update_one({'_id': patient_id}, {'$set': data})
+        update = {'$set': data}
+        if 'glycemic_ranges' in data:
+            patient = db.users.find_one({'_id': patient_id}, {'glycemic_ranges': 1})
+            if patient is None:
+                error(404, 'User not found')
+            # Previews are built for the ranges, the targets are only applied when they're read. Bumping the version
+            # makes the previews of the patient get rebuilt with the new ranges
+            if list(patient.get('glycemic_ranges') or DEFAULT_GLYCEMIC_RANGES) != data['glycemic_ranges']:
+                update['$inc'] = {'settings_version': 1}
+        if db.users.update_one({'_id': patient_id}, update).matched_count == 0:
+            error(404, 'User not found')
+        principal_cache.invalidate(patient_id)
         return jsonify({'message': 'Updated glycemic parameters'})
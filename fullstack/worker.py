@@ -0,0 +1,79 @@
+"""
+Author: Alexander
+Description: Background precomputation of the doctor dashboard previews. A scheduler walks all patients every
+             interval and hands them out in chunks to a pool of worker processes, which build missing preview
+             states and move the existing ones forward, so requests only have to read them.
+             Started with precompute_worker.py
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import multiprocessing
+import time
+
+from fullstack import app, db
+from fullstack.previews import refresh_states
+
+PATIENT_FIELDS = {'_id': 1, 'glycemic_ranges': 1, 'glycemic_targets': 1, 'settings_version': 1}
+
+
+def refresh_chunk(patient_ids: List) -> int:
+    """
+    Refreshes the preview states of a chunk of patients. Runs in a worker process
+    :param patient_ids: ObjectIds of the patients
+    :return: Number of patients refreshed
+    """
+    patients = list(db.users.find({'_id': {'$in': patient_ids}}, PATIENT_FIELDS))
+    refresh_states(patients)
+    return len(patients)
+
+
+def get_patient_chunks(chunk_size: int):
+    chunk = []
+    for patient in db.users.find({'is_doctor': {'$ne': True}}, {'_id': 1}):
+        chunk.append(patient['_id'])
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_once(executor: Optional[ProcessPoolExecutor], chunk_size: int) -> int:
+    """
+    Refreshes the preview states of all patients
+    :param executor: Pool to spread the chunks over, or None to refresh them in this process
+    :param chunk_size: Number of patients per chunk
+    :return: Number of patients refreshed
+    """
+    if executor is None:
+        return sum(refresh_chunk(chunk) for chunk in get_patient_chunks(chunk_size))
+    # Every worker process has its own MongoClient, as clients can't be shared over a fork
+    futures = [executor.submit(refresh_chunk, chunk) for chunk in get_patient_chunks(chunk_size)]
+    return sum(future.result() for future in futures)
+
+
+def run(interval: float, workers: int, chunk_size: int, once: bool = False):
+    """
+    Runs the scheduler, refreshing all patients every interval seconds until interrupted
+    :param interval: Seconds between the start of two runs
+    :param workers: Number of worker processes, 0 to refresh in this process
+    :param chunk_size: Number of patients per chunk
+    :param once: Only run once
+    """
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        while True:
+            start = time.monotonic()
+            count = run_once(executor, chunk_size)
+            duration = time.monotonic() - start
+            app.logger.info("Refreshed previews of %d patients in %.1f s", count, duration)
+            if once:
+                break
+            time.sleep(max(interval - duration, 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Author: Alexander
+Description: This script starts the background worker that keeps the previews of all patients precomputed,
+             so it can be run next to start_server.py
+"""
+from dotenv import load_dotenv
+import argparse
+import logging
+import os
+
+load_dotenv(dotenv_path=".env")
+
+parser = argparse.ArgumentParser(description="Keep the dashboard previews of all patients precomputed")
+parser.add_argument('--interval', type=float, default=float(os.getenv("PRECOMPUTE_INTERVAL") or 300),
+                    help="Seconds between two runs over all patients")
+parser.add_argument('--workers', type=int, default=int(os.getenv("PRECOMPUTE_WORKERS") or os.cpu_count()),
+                    help="Number of worker processes, 0 to work in a single process")
+parser.add_argument('--chunk-size', type=int, default=200, help="Number of patients per task")
+parser.add_argument('--once', action='store_true', help="Only run over all patients once")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    from fullstack import app
+    from fullstack.worker import run
+    # The worker reports every run on the app logger
+    app.logger.setLevel(logging.INFO)
+    run(args.interval, args.workers, args.chunk_size, args.once)
@@ -11,35 +11,58 @@ try:
 except ModuleNotFoundError:
     print("Run: python -m pip install pymongo")
     exit(1)
+from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from time import time
+from typing import Iterable, Iterator, List
+import os
 import random
 
+import numpy as np
 
-client = MongoClient("mongodb://localhost:27017")
+
+MONGO_URI = "mongodb://localhost:27017"
+client = MongoClient(MONGO_URI)
 db = client["fullstack"]
 
+INSERT_BATCH_SIZE = 10000
+INSERT_WORKERS = 4
+
+
+def setup_indexes(database=None):
+    """
+    Creates the time series collections and the indexes
+    :param database: The database, by default the one of this script
+    """
+    if database is None:
+        database = db
+    database.users.drop_indexes()
+    database.users.create_index('email', unique=True, collation={'locale': 'en', 'strength': 2})
 
-def setup_indexes():
-    db.users.drop_indexes()
-    db.users.create_index('email', unique=True, collation={'locale': 'en', 'strength': 2})
+    database.diagnosis.drop_indexes()
+    database.diagnosis.create_index([('patient', 1), ('_id', 1)])
 
-    db.diagnosis.drop_indexes()
-    db.diagnosis.create_index('patient')
+    database.cache.drop_indexes()
+    # The cache is rebuilt from the data, and older versions could leave several documents per patient, which
+    # would make the unique index fail
+    database.cache.delete_many({})
+    database.cache.create_index('patient', unique=True)
+    database.cache.create_index('expires', expireAfterSeconds=0)
 
-    db.cache.drop_indexes()
-    db.cache.create_index('patient')
-    db.cache.create_index('ttl')
+    database.note.drop_indexes()
+    database.note.create_index([('patient', 1), ('timestamp', 1), ('_id', 1)])
 
-    db.note.drop_indexes()
-    db.note.create_index('patient')
+    database.rollups.drop_indexes()
+    database.rollups.create_index([('patient', 1), ('period', 1), ('start', 1)], unique=True)
 
     data_types = ['cgm', 'meals', 'basal', 'bolus', 'exercise']
     for data in data_types:
         try:
-            db.create_collection(data, timeseries={'timeField': 'timestamp', 'granularity': 'minutes', 'metaField': 'patient'})
+            database.create_collection(data, timeseries={'timeField': 'timestamp', 'granularity': 'minutes', 'metaField': 'patient'})
         except CollectionInvalid:
             pass
+        database[data].create_index([('patient', 1), ('timestamp', 1)])
 
 
 def add_doctor():
@@ -58,110 +81,168 @@ def add_doctor():
     }).inserted_id
 
 
+def read_rows(path: str) -> Iterator[np.ndarray]:
+    """
+    Reads a CSV file of one patient per line and one column per time step, a line at a time
+    :param path: Path to the CSV file
+    :return: Generator of the rows as arrays
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            yield np.array(line.strip().split(","), dtype=np.float64)
+
+
+def series_documents(path: str, users: List[ObjectId], times: List[datetime], skip_zeros: bool) -> Iterator[dict]:
+    """
+    Generates the documents of a data type from its CSV file
+    :param path: Path to the CSV file
+    :param users: The user id of every line
+    :param times: The timestamp of every column
+    :param skip_zeros: Whether zero values mean there's no reading
+    :return: Generator of documents
+    """
+    for user, row in zip(users, read_rows(path)):
+        columns = np.flatnonzero(row) if skip_zeros else range(len(row))
+        for j, v in zip(columns, row[columns].tolist()):
+            yield {'timestamp': times[j], 'patient': user, 'value': v}
+
+
+def exercise_documents(path: str, users: List[ObjectId], times: List[datetime]) -> Iterator[dict]:
+    """
+    Generates the exercise documents from its CSV file, where every run of non-zero values is one exercise
+    with the intensity of its last value
+    """
+    for user, row in zip(users, read_rows(path)):
+        val_len = 0
+        val = None
+        for j, v in enumerate(row.tolist()):
+            if val_len > 0 and v == 0:
+                yield {'timestamp': times[j - val_len], 'patient': user, 'duration': val_len * 300.0,
+                       'intensity': val / 100}
+                val = None
+                val_len = 0
+
+            if v != 0:
+                val_len += 1
+                val = v
+
+
+def batched(documents: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_parallel(collection, documents: Iterable[dict], workers: int = INSERT_WORKERS,
+                    batch_size: int = INSERT_BATCH_SIZE) -> int:
+    """
+    Inserts documents in unordered batches from a couple of threads while they're being generated.
+    At most two batches per thread are in memory at a time, so memory doesn't grow with the number of documents
+    :param collection: The collection to insert into
+    :param documents: Iterable of documents, preferably a generator
+    :param workers: Number of inserting threads
+    :param batch_size: Number of documents per insert
+    :return: Number of inserted documents
+    """
+    start_time = time()
+    last_report = start_time
+    inserted = 0
+    pending = set()
+
+    def collect(done):
+        nonlocal inserted
+        for future in done:
+            inserted += len(future.result().inserted_ids)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batched(documents, batch_size):
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(collection.insert_many, batch, ordered=False))
+
+            if time() - last_report >= 5:
+                last_report = time()
+                print(f"  {inserted} documents, {inserted / (last_report - start_time):.0f}/s")
+        collect(wait(pending).done)
+
+    elapsed = time() - start_time
+    print(f"  {inserted} documents in {elapsed:.1f}s, {inserted / max(elapsed, 1e-9):.0f}/s")
+    return inserted
+
+
 def setup_dummy_data():
     start_time = time()
     client.drop_database("fullstack")
     setup_indexes()
 
+    last_time = datetime(year=2022,month=1,day=29)
+    today = datetime.now()
+    today = datetime(year=today.year, month=today.month, day=today.day)
+    offset_time = today - last_time
+
     with open('data/time.csv', 'r') as f:
         format_data = "%d-%b-%Y %H:%M:%S"
-        times = [datetime.strptime(t, format_data) for t in f.read().strip().split(",")]
+        times = [datetime.strptime(t, format_data) + offset_time for t in f.read().strip().split(",")]
     password_hash = '$2b$12$Cy8R6vf8dLL5aX.K.Ty1Y.lHZqWeIpPiPngxTUogzHeYldUujviA2'  # password1
 
     print("Adding users", time() - start_time)
-    users = []
     min_age = int(datetime(2007,12,31).timestamp())
+    users = db.users.insert_many([{'email': f'User{i}@example.com',
+                                   'password_hash': password_hash,
+                                   'first_name': f'User{i}',
+                                   'last_name': f'number{i}',
+                                   'birthdate': datetime.fromtimestamp(random.randrange(0, min_age)),
+                                   } for i in range(1000)]).inserted_ids
 
-    for i in range(1000):
-        age = random.randrange(0, min_age)
+    print("Adding CGM measurements", time() - start_time)
+    insert_parallel(db.cgm, series_documents('data/measurements.csv', users, times, skip_zeros=False))
 
-        users.append(db.users.insert_one({'email': f'User{i}@example.com',
-                                          'password_hash': password_hash,
-                                          'first_name': f'User{i}',
-                                          'last_name': f'number{i}',
-                                          'birthdate': datetime.fromtimestamp(age),
-                                          }).inserted_id)
+    for name in ['meals', 'basal', 'bolus']:
+        print(f"Adding {name}", time() - start_time)
+        insert_parallel(db[name], series_documents(f'data/{name}.csv', users, times, skip_zeros=True))
 
-    last_time = datetime(year=2022,month=1,day=29)
-    today = datetime.now()
-    today = datetime(year=today.year, month=today.month, day=today.day)
-    offset_time = today - last_time
+    print("Adding exercise", time() - start_time)
+    insert_parallel(db.exercise, exercise_documents('data/exercise.csv', users, times))
+    add_doctor()
+    print("Done", time() - start_time)
 
-    print("Adding CGM measurements", time() - start_time)
-    cgm = []
-    with open('data/measurements.csv', 'r') as f:
-        l = [line.strip().split(",") for line in f]
-
-        for j in range(len(l[0])):
-            for i in range(1000):
-                cgm.append({'timestamp': times[j]+offset_time, 'patient': users[i], 'value': float(l[i][j])})
-    db.cgm.insert_many(cgm)
-    del cgm
-
-    print("Adding meals", time() - start_time)
-    meals = []
-    with open('data/meals.csv', 'r') as f:
-        l = [line.strip().split(",") for line in f]
-        for j in range(len(l[0])):
-            for i in range(1000):
-                v = float(l[i][j])
-                if v != 0:
-                    meals.append({'timestamp': times[j]+offset_time, 'patient': users[i], 'value': v})
-
-    db.meals.insert_many(meals)
-    del meals
-
-    print("Adding basal", time() - start_time)
-    basal = []
-    with open('data/basal.csv', 'r') as f:
-        l = [line.strip().split(",") for line in f]
-
-        for j in range(len(l[0])):
-            for i in range(1000):
-                v = float(l[i][j])
-                if v != 0:
-                    basal.append({'timestamp': times[j]+offset_time, 'patient': users[i], 'value': v})
-
-    db.basal.insert_many(basal)
-    del basal
-
-    print("Adding bolus", time() - start_time)
-    bolus = []
-    with open('data/bolus.csv', 'r') as f:
-        l = [line.strip().split(",") for line in f]
-
-        for j in range(len(l[0])):
-            for i in range(1000):
-                v = float(l[i][j])
-                if v != 0:
-                    bolus.append({'timestamp': times[j]+offset_time, 'patient': users[i], 'value': v})
-
-    db.bolus.insert_many(bolus)
-    del bolus
 
-    print("Adding exercise", time() - start_time)
-    exercise = []
-    with open('data/exercise.csv', 'r') as f:
-        l = [line.strip().split(",") for line in f]
+def setup_synthetic_data():
+    import synthetic_data
 
-        val_len = 0
-        val = None
-        for i in range(1000):
-            for j in range(len(l[i])):
-                v = float(l[i][j])
-                if val_len > 0 and v == 0:
-                    exercise.append({'timestamp': times[j - val_len]+offset_time, 'patient': users[i], 'duration': val_len * 300.0,
-                                     'intensity': val / 100})
-                    val = None
-                    val_len = 0
-
-                if v != 0:
-                    val_len += 1
-                    val = v
-
-    db.exercise.insert_many(exercise)
-    del exercise
-    add_doctor()
+    patients = int(input("Number of patients: "))
+    days = int(input("Days of data: "))
+    doctors = int(input("Number of doctors: "))
+    panel_size = input("Patients per doctor (empty for all): ")
+
+    start_time = time()
+    client.drop_database("fullstack")
+    setup_indexes()
+    synthetic_data.seed(db, patients, days, doctors=doctors, panel_size=int(panel_size) if panel_size else None,
+                        workers=os.cpu_count(), mongo_uri=MONGO_URI)
+    print("Done", time() - start_time)
+
+
+def backfill_rollups():
+    # The rollups are maintained by the server code, which reads its database from the environment
+    os.environ.setdefault("MONGO_URI", MONGO_URI)
+    os.environ.setdefault("MONGO_DB_NAME", db.name)
+    from fullstack.rollups import rebuild_rollups
+
+    start_time = time()
+    patients = [user['_id'] for user in db.users.find({'is_doctor': {'$ne': True}}, {'_id': 1})]
+    with ThreadPoolExecutor(max_workers=INSERT_WORKERS) as executor:
+        for i, _ in enumerate(executor.map(rebuild_rollups, patients)):
+            if (i + 1) % 100 == 0 or i + 1 == len(patients):
+                elapsed = time() - start_time
+                print(f"  {i + 1}/{len(patients)} patients, {(i + 1) / max(elapsed, 1e-9):.1f}/s")
+    print("Done", time() - start_time)
 
 
 def main():
@@ -169,6 +250,8 @@ def main():
     print("[1] Setup dummy data")
     print("[2] Setup indexes")
     print("[3] Add doctor")
+    print("[4] Setup synthetic data")
+    print("[5] Backfill rollups")
     inp = int(input("> "))
     if inp == 1:
         setup_dummy_data()
@@ -176,6 +259,10 @@ def main():
         setup_indexes()
     elif inp == 3:
         add_doctor()
+    elif inp == 4:
+        setup_synthetic_data()
+    elif inp == 5:
+        backfill_rollups()
     else:
         print("Invalid")
 
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 """
 Author: Alexander
-Description: This script will prepare a couple of things and then start the server
+Description: This script will prepare a couple of things and then start the server.
+             By default it serves with gunicorn (or waitress where gunicorn isn't available, like on Windows)
+             using several worker processes with a couple of threads each. --dev starts the Flask debug server instead
 """
 from dotenv import load_dotenv
+import argparse
 import os
 import shutil
+import signal
 
 if not os.path.exists(".env"):
     print("No .env file. Copying .env.example over for you")
@@ -18,5 +22,88 @@ except FileExistsError:
 
 load_dotenv(dotenv_path=".env")
 
-from fullstack import app
-app.run(debug=True)
+parser = argparse.ArgumentParser(description="Start the server")
+parser.add_argument('--dev', action='store_true', help="Run the Flask debug server with the reloader")
+parser.add_argument('--host', default=os.getenv("SERVER_HOST") or "127.0.0.1")
+parser.add_argument('--port', type=int, default=int(os.getenv("SERVER_PORT") or 5000))
+parser.add_argument('--workers', type=int, default=int(os.getenv("SERVER_WORKERS") or os.cpu_count()),
+                    help="Number of worker processes (gunicorn only)")
+parser.add_argument('--threads', type=int, default=int(os.getenv("SERVER_THREADS") or 4),
+                    help="Number of threads per worker process")
+parser.add_argument('--graceful-timeout', type=int,
+                    default=int(os.environ["SERVER_GRACEFUL_TIMEOUT"]) if os.getenv("SERVER_GRACEFUL_TIMEOUT") else None,
+                    help="Seconds running requests get to finish on shutdown, 30 by default (gunicorn only)")
+parser.add_argument('--server', choices=['gunicorn', 'waitress'], default=os.getenv("SERVER"),
+                    help="The WSGI server to use, by default gunicorn if it's installed and otherwise waitress")
+
+
+def close_worker():
+    """
+    Releases what a worker process holds once it stopped taking requests
+    """
+    from fullstack import mongo_client, passwords, series
+    series.shutdown()
+    passwords.shutdown()
+    mongo_client.close()
+
+
+def serve_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('graceful_timeout', 30 if args.graceful_timeout is None else args.graceful_timeout)
+            self.cfg.set('worker_exit', lambda server, worker: close_worker())
+
+        def load(self):
+            # Imported in the workers rather than before forking, as a MongoClient must not be shared between processes
+            from fullstack import app
+            return app
+
+    Server().run()
+
+
+def serve_waitress(args):
+    from waitress import serve
+    from fullstack import app
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    if args.graceful_timeout is not None:
+        print("waitress has no graceful timeout, --graceful-timeout is ignored")
+    # waitress only stops on ctrl-c by itself
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_worker()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # Every request thread and every thread fetching data in parallel may hold a connection at the same time
+    os.environ.setdefault("MONGO_MAX_POOL_SIZE", str(args.threads + int(os.getenv("DATA_FETCH_WORKERS") or 8)))
+
+    if args.dev:
+        from fullstack import app
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        server = args.server
+        if server is None:
+            try:
+                import gunicorn
+                server = 'gunicorn'
+            except ImportError:
+                server = 'waitress'
+        if server == 'gunicorn':
+            serve_gunicorn(args)
+        else:
+            serve_waitress(args)
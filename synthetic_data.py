@@ -0,0 +1,289 @@
+"""
+Author: Alexander
+Description: Generation of synthetic users and data, modeled on setup_database.setup_dummy_data but without the
+             CSV files, so any number of patients and days can be created anywhere (including mongomock).
+             The series come from a simple physiological model that is simulated for a chunk of patients at once:
+             meals raise glucose as the carbs are absorbed, boluses (dosed with some error, sometimes forgotten)
+             and exercise lower it, on top of a personal baseline, the dawn phenomenon and slow random drift.
+             These effects fade out over a couple of hours, standing in for the corrections a patient makes.
+             Chunks are generated and written by worker processes when there's a MongoDB to connect to
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional
+import multiprocessing
+
+import numpy as np
+
+PASSWORD_HASH = '$2b$12$Cy8R6vf8dLL5aX.K.Ty1Y.lHZqWeIpPiPngxTUogzHeYldUujviA2'  # password1
+SAMPLE_MINUTES = 5
+SAMPLES_PER_DAY = 24 * 60 // SAMPLE_MINUTES
+# Chunks are sized so the simulation of a chunk holds about this many samples per array
+CHUNK_SAMPLES = 2_000_000
+BATCH_SIZE = 10000
+
+# Main meals as (hour, standard deviation in hours, probability)
+MEALS = [(7.5, 0.75, 0.9), (12.5, 0.75, 0.95), (18.5, 1.0, 0.95)]
+
+
+def make_users(n: int, rng: np.random.Generator, prefix: str = 'User') -> List[dict]:
+    min_age = int(datetime(2007, 12, 31).timestamp())
+    ages = rng.integers(0, min_age, n).tolist()
+    return [{'email': f'{prefix}{i}@example.com',
+             'password_hash': PASSWORD_HASH,
+             'first_name': f'{prefix}{i}',
+             'last_name': f'number{i}',
+             'birthdate': datetime.fromtimestamp(age),
+             } for i, age in enumerate(ages)]
+
+
+def _kernel(minutes: float) -> np.ndarray:
+    return np.arange(SAMPLES_PER_DAY) * SAMPLE_MINUTES / minutes
+
+
+def _absorption(scale: float) -> np.ndarray:
+    """
+    Fraction of a dose that has taken effect over time (a gamma CDF), fading out over about six hours
+    """
+    x = _kernel(scale)
+    return (1 - np.exp(-x) * (1 + x)) * np.exp(-_kernel(360))
+
+
+def _convolve(impulses: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Convolves every row with a kernel, truncated to the length of the rows
+    """
+    n = impulses.shape[1] + len(kernel)
+    return np.fft.irfft(np.fft.rfft(impulses, n) * np.fft.rfft(kernel, n), n)[:, :impulses.shape[1]]
+
+
+def _place(shape, rows: np.ndarray, index: np.ndarray, values: np.ndarray) -> np.ndarray:
+    out = np.zeros(shape)
+    keep = (index >= 0) & (index < shape[1])
+    np.add.at(out, (rows[keep], index[keep]), values[keep])
+    return out
+
+
+def simulate(patients: int, days: int, rng: np.random.Generator) -> dict:
+    """
+    Simulates the data of a chunk of patients on a grid of SAMPLE_MINUTES
+    :param patients: Number of patients
+    :param days: Number of days
+    :param rng: Random generator
+    :return: A dict of (patients x samples) arrays 'cgm' (nan where the sensor has no reading), 'meals' and 'bolus'
+             (0 where there's none), 'basal' with the rate in U/h at every hour (patients x hours) and 'exercise',
+             a tuple of (patient, sample, duration in minutes, intensity) arrays
+    """
+    # One extra day up front, so the first day starts with the effects of the day before
+    n = (days + 1) * SAMPLES_PER_DAY
+    shape = (patients, n)
+    hours = np.arange(n) * SAMPLE_MINUTES / 60 % 24
+
+    baseline = np.clip(rng.normal(7.5, 1.2, patients), 5.5, 11)
+    icr = rng.uniform(6, 15, patients)  # Grams of carbs per unit of insulin
+    isf = rng.uniform(1.5, 4, patients)  # mmol/L per unit of insulin
+    dosing_error = rng.uniform(0.15, 0.35, patients)
+    activity = rng.uniform(0, 0.5, patients)
+
+    # Meals at roughly the usual times, and snacks in between
+    day_start = np.arange(days + 1) * SAMPLES_PER_DAY
+    rows, index, carbs = [], [], []
+    for hour, deviation, probability in MEALS:
+        time = rng.normal(hour, deviation, (patients, days + 1))
+        eaten = rng.random((patients, days + 1)) < probability
+        rows.append(np.nonzero(eaten)[0])
+        index.append((day_start + time * 60 / SAMPLE_MINUTES).astype(np.int64)[eaten])
+        carbs.append(np.round(rng.gamma(4, 12, eaten.sum())))
+    snacks = rng.poisson(1, (patients, days + 1))
+    rows.append(np.repeat(np.arange(patients), snacks.sum(axis=1)))
+    index.append(np.repeat(np.tile(day_start, patients), snacks.ravel())
+                 + (rng.uniform(9, 22, snacks.sum()) * 60 / SAMPLE_MINUTES).astype(np.int64))
+    carbs.append(np.round(rng.gamma(2, 8, snacks.sum())) + 5)
+    rows, index, carbs = np.concatenate(rows), np.concatenate(index), np.concatenate(carbs)
+    meals = _place(shape, rows, index, carbs)
+
+    # Boluses with every meal, sometimes forgotten, dosed with a personal error
+    units = carbs / icr[rows] * rng.lognormal(0, dosing_error[rows])
+    units[rng.random(len(units)) < 0.05] = 0
+    bolus = _place(shape, rows, index, np.round(units, 1))
+
+    # Exercise mostly in the afternoon or evening
+    exercised = rng.random((patients, days + 1)) < activity[:, None]
+    ex_rows = np.nonzero(exercised)[0]
+    ex_index = (day_start + rng.normal(17, 2, (patients, days + 1)) * 60 / SAMPLE_MINUTES).astype(np.int64)[exercised]
+    duration = rng.choice([20, 30, 45, 60, 90], len(ex_rows)).astype(np.float64)
+    intensity = np.round(rng.uniform(0.3, 0.9, len(ex_rows)), 2)
+    load = _place(shape, ex_rows, ex_index, intensity * duration / 60)
+
+    # Slow random drift, an Ornstein-Uhlenbeck process with a 45 minute time constant
+    decay = np.exp(-_kernel(45))
+    drift = _convolve(rng.normal(0, 1, shape), decay) / np.sqrt((decay ** 2).sum())
+
+    dawn = np.exp(-((hours - 6) / 1.5) ** 2)
+    glucose = (baseline[:, None]
+               + rng.uniform(0.3, 1.5, patients)[:, None] * dawn
+               + _convolve(meals * (isf / icr)[:, None], _absorption(30))
+               - _convolve(bolus * isf[:, None], _absorption(55))
+               - _convolve(load * 2.5, _kernel(60) * np.exp(1 - _kernel(60)))
+               + drift * rng.uniform(0.4, 1, patients)[:, None]
+               + rng.normal(0, 0.15, shape))
+    cgm = np.round(np.clip(glucose, 2.2, 22.2), 1)
+
+    # Single missed readings, and gaps of up to two hours now and then (like a sensor change)
+    missing = rng.random(shape) < 0.01
+    gaps = rng.random((patients, days + 1)) < 0.1
+    gap_start = (day_start + rng.integers(0, SAMPLES_PER_DAY, (patients, days + 1)))[gaps]
+    gap_rows = np.nonzero(gaps)[0]
+    edges = _place((patients, n + 1), gap_rows, gap_start, np.ones(len(gap_start)))
+    edges -= _place((patients, n + 1), gap_rows, gap_start + rng.integers(6, 24, len(gap_start)),
+                    np.ones(len(gap_start)))
+    missing |= np.cumsum(edges, axis=1)[:, :n] > 0.5
+    cgm[missing] = np.nan
+
+    # A basal profile per patient with more insulin in the early morning
+    profile = rng.uniform(0.5, 1.5, patients)[:, None] * (1 + 0.3 * np.exp(-((np.arange(24) - 5) / 2) ** 2))
+    basal = np.round(np.tile(profile, days), 2)
+
+    skip = SAMPLES_PER_DAY
+    ex_keep = ex_index >= skip
+    return {
+        'cgm': cgm[:, skip:],
+        'meals': meals[:, skip:],
+        'bolus': bolus[:, skip:],
+        'basal': basal,
+        'exercise': (ex_rows[ex_keep], ex_index[ex_keep] - skip, duration[ex_keep], intensity[ex_keep]),
+    }
+
+
+def make_documents(patient_ids: List, days: int, end: datetime, rng: np.random.Generator) -> Dict[str, Iterator[dict]]:
+    """
+    Simulates a chunk of patients and turns the result into documents
+    :param patient_ids: ObjectIds of the patients
+    :param days: Number of days of data, ending at end
+    :param end: End of the data
+    :param rng: Random generator
+    :return: A dict of data type to a generator of documents
+    """
+    data = simulate(len(patient_ids), days, rng)
+    start = np.datetime64(end - timedelta(days=days), 's')
+    # Every sensor reads at its own second within the 5 minutes
+    phase = rng.integers(0, SAMPLE_MINUTES * 60, len(patient_ids))
+
+    def times(i: int, index: np.ndarray) -> list:
+        seconds = index * SAMPLE_MINUTES * 60 + phase[i]
+        return (start + seconds.astype('timedelta64[s]')).astype('datetime64[us]').tolist()
+
+    def series(col: str) -> Iterator[dict]:
+        for i, patient_id in enumerate(patient_ids):
+            row = data[col][i]
+            index = np.flatnonzero(~np.isnan(row)) if col == 'cgm' else np.flatnonzero(row)
+            for timestamp, value in zip(times(i, index), row[index].tolist()):
+                yield {'timestamp': timestamp, 'patient': patient_id, 'value': value}
+
+    def basal() -> Iterator[dict]:
+        index = np.arange(days * 24) * (60 // SAMPLE_MINUTES)
+        for i, patient_id in enumerate(patient_ids):
+            for timestamp, value in zip(times(i, index), data['basal'][i].tolist()):
+                yield {'timestamp': timestamp, 'patient': patient_id, 'value': value}
+
+    def exercise() -> Iterator[dict]:
+        rows, index, duration, intensity = data['exercise']
+        for i, patient_id in enumerate(patient_ids):
+            mine = rows == i
+            for timestamp, d, v in zip(times(i, index[mine]), duration[mine].tolist(), intensity[mine].tolist()):
+                yield {'timestamp': timestamp, 'patient': patient_id, 'duration': d * 60, 'intensity': v}
+
+    return {'cgm': series('cgm'), 'meals': series('meals'), 'bolus': series('bolus'), 'basal': basal(),
+            'exercise': exercise()}
+
+
+def _batched(documents: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_chunk(db, patient_ids: List, days: int, end: datetime, seed: np.random.SeedSequence,
+                batch_size: int = BATCH_SIZE) -> int:
+    """
+    Generates the data of a chunk of patients and inserts it in unordered batches
+    :return: Number of inserted documents
+    """
+    inserted = 0
+    for col, documents in make_documents(patient_ids, days, end, np.random.default_rng(seed)).items():
+        for batch in _batched(documents, batch_size):
+            db[col].insert_many(batch, ordered=False)
+            inserted += len(batch)
+    return inserted
+
+
+_process_db = None
+
+
+def _init_process(mongo_uri: str, db_name: str):
+    global _process_db
+    from pymongo import MongoClient
+    _process_db = MongoClient(mongo_uri)[db_name]
+
+
+def _write_chunk_process(patient_ids: List, days: int, end: datetime, seed: np.random.SeedSequence,
+                         batch_size: int) -> int:
+    return write_chunk(_process_db, patient_ids, days, end, seed, batch_size)
+
+
+def seed(db, patients: int, days: int, seed: int = 0, doctors: int = 1, panel_size: Optional[int] = None,
+         workers: int = 0, mongo_uri: Optional[str] = None, chunk_size: Optional[int] = None) -> dict:
+    """
+    Fills a database with patients, their data and doctors. Everyone has password1.
+    The first doctor is Doctor@example.com, the others Doctor<i>@example.com
+    :param db: A pymongo or mongomock database
+    :param patients: Number of patients
+    :param days: Days of data per patient, ending now
+    :param seed: Random seed, the data doesn't depend on the number of workers
+    :param doctors: Number of doctors
+    :param panel_size: Number of random patients every doctor can view, or None for all of them
+    :param workers: Number of processes generating and writing data, 0 to do it in this process
+    :param mongo_uri: URI of the database for the worker processes, required if there are any
+    :param chunk_size: Number of patients simulated at once, by default as many as fit in CHUNK_SAMPLES
+    :return: A dict with the 'patients' and 'doctor' emails
+    """
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+    users = make_users(patients, rng)
+    patient_ids = []
+    for batch in _batched(users, BATCH_SIZE):
+        patient_ids += db.users.insert_many(batch).inserted_ids
+
+    end = datetime.now().replace(second=0, microsecond=0)
+    chunk_size = chunk_size or max(CHUNK_SAMPLES // ((days + 1) * SAMPLES_PER_DAY), 1)
+    chunks = [patient_ids[i:i + chunk_size] for i in range(0, len(patient_ids), chunk_size)]
+    chunk_seeds = seeds.spawn(len(chunks))
+    if workers > 0:
+        if mongo_uri is None:
+            raise ValueError("Worker processes need a mongo_uri")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_process, initargs=(mongo_uri, db.name)) as executor:
+            futures = [executor.submit(_write_chunk_process, chunk, days, end, chunk_seed, BATCH_SIZE)
+                       for chunk, chunk_seed in zip(chunks, chunk_seeds)]
+            for future in futures:
+                future.result()
+    else:
+        for chunk, chunk_seed in zip(chunks, chunk_seeds):
+            write_chunk(db, chunk, days, end, chunk_seed)
+
+    doctor_docs = []
+    for i in range(doctors):
+        viewable = patient_ids if panel_size is None else \
+            [patient_ids[j] for j in np.sort(rng.choice(len(patient_ids), min(panel_size, len(patient_ids)),
+                                                        replace=False))]
+        doctor_docs.append({'email': 'Doctor@example.com' if i == 0 else f'Doctor{i}@example.com',
+                            'password_hash': PASSWORD_HASH, 'first_name': 'Dr.', 'last_name': 'Pepper',
+                            'is_doctor': True, 'viewable': viewable})
+    if doctor_docs:
+        db.users.insert_many(doctor_docs)
+    return {'patients': [user['email'] for user in users], 'doctor': 'Doctor@example.com'}
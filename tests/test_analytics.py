@@ -0,0 +1,92 @@
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+os.environ["TESTING"] = "TRUE"
+os.environ["MONGO_DB_NAME"] = "test"
+from fullstack.analytics import compute_preview, check_distributions, get_bands, get_slots, glycemic_metrics, \
+    slot_percentiles, cohort_sums, cohort_metrics, gmi
+from fullstack import DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS
+
+
+def test_bands():
+    bands = get_bands(DEFAULT_GLYCEMIC_RANGES, np.array([2.0, 3.0, 3.5, 3.9, 7.0, 10.0, 13.9, 20.0]))
+    assert bands.tolist() == [0, 1, 1, 2, 2, 3, 4, 4]
+
+
+def test_slots():
+    times = [datetime.datetime(2022, 3, 1, 0, 0), datetime.datetime(2022, 3, 1, 0, 14), datetime.datetime(2022, 3, 1, 13, 50),
+             datetime.datetime(2022, 7, 1, 23, 59)]
+    slots = get_slots(np.array([t.timestamp() for t in times]))
+    assert slots.tolist() == [t.hour * 4 + t.minute // 15 for t in times]
+
+
+def test_check_distributions():
+    assert check_distributions([0.0, 0.0, 1.0, 0.0, 0.0], DEFAULT_GLYCEMIC_TARGETS) == []
+    assert check_distributions([0.5, 0.0, 0.5, 0.0, 0.0], DEFAULT_GLYCEMIC_TARGETS) == [0, 1, 2]
+
+
+def test_preview():
+    start = datetime.datetime(2022, 3, 1).timestamp()
+    timestamps = start + np.array([600, 1200, 1800, 87000])
+    values = np.array([3.5, 5.0, 12.0, 7.0])
+    preview = compute_preview(timestamps, values, start, DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS)
+
+    assert preview['values'][0] == pytest.approx((3.5 + 7.0) / 2)
+    assert preview['values'][1] == pytest.approx(5.0)
+    assert preview['values'][2] == pytest.approx(12.0)
+    assert preview['values'][3] is None
+    assert preview['distribution'] == pytest.approx([0, 600 / 87000, 85800 / 87000, 600 / 87000, 0])
+    assert preview['problems'] == []
+
+
+def test_empty_preview():
+    preview = compute_preview(np.array([]), np.array([]), 0.0, DEFAULT_GLYCEMIC_RANGES, DEFAULT_GLYCEMIC_TARGETS)
+    assert preview['values'] == [None] * 96
+    assert preview['distribution'] == [0, 0, 0, 0, 0]
+
+
+def test_slot_percentiles():
+    rng = np.random.default_rng(0)
+    slots = rng.integers(0, 96, 2000)
+    slots[slots == 7] = 8
+    values = rng.normal(8, 2, 2000)
+    percentiles = slot_percentiles(slots, values, [5, 25, 50, 75, 95])
+    for slot in [0, 8, 95]:
+        assert percentiles[slot] == pytest.approx(np.percentile(values[slots == slot], [5, 25, 50, 75, 95]))
+    assert np.isnan(percentiles[7]).all()
+
+
+def test_glycemic_metrics():
+    start = datetime.datetime(2022, 3, 1).timestamp()
+    values = np.array([2.5, 3.5, 6.0, 8.0, 12.0, 15.0])
+    metrics = glycemic_metrics(start + np.arange(6) * 300, values, DEFAULT_GLYCEMIC_RANGES)
+    assert metrics['mean'] == pytest.approx(values.mean())
+    assert metrics['cv'] == pytest.approx(values.std() / values.mean() * 100)
+    assert metrics['gmi'] == pytest.approx(gmi(values.mean()))
+    assert metrics['distribution'] == pytest.approx([1 / 6, 1 / 6, 2 / 6, 1 / 6, 1 / 6])
+    assert (metrics['tbr'], metrics['tir'], metrics['tar']) == pytest.approx((2 / 6, 2 / 6, 2 / 6))
+    assert metrics['agp']['50'][:2] == pytest.approx([3.5, 12.0])
+    assert metrics['agp']['50'][2] is None
+
+
+def test_gmi():
+    # A mean of 7 mmol/L (126 mg/dL) is a GMI of about 6.3 %
+    assert gmi(7.0) == pytest.approx(6.327, abs=1e-3)
+    assert gmi(np.array([7.0, 10.0])) == pytest.approx([6.327, 7.619], abs=1e-3)
+
+
+def test_cohort_metrics():
+    index = np.array([0, 0, 0, 0, 2, 2])
+    values = np.array([3.5, 3.0, 7.0, 3.8, 3.2, 8.0])
+    sums = cohort_sums(index, values, 3, DEFAULT_GLYCEMIC_RANGES)
+    assert sums['hypos'].tolist() == [2, 0, 1]
+    metrics = cohort_metrics(sums)
+    assert metrics['mean'][0] == pytest.approx(values[:4].mean())
+    assert metrics['gmi'][0] == pytest.approx(gmi(values[:4].mean()))
+    assert metrics['sd'][2] == pytest.approx(values[4:].std())
+    assert metrics['tbr'][0] == pytest.approx(0.75)
+    assert np.isnan(metrics['mean'][1]) and np.isnan(metrics['hypos'][1])
+    assert cohort_metrics(cohort_sums(np.zeros(0), np.zeros(0), 0, DEFAULT_GLYCEMIC_RANGES))['mean'].shape == (0,)
@@ -1,20 +1,30 @@
+import datetime
 import time
 
+import jwt
 import pytest
 from flask.testing import FlaskClient
 import os
-from bson import ObjectId
+from base64 import urlsafe_b64encode
+from bson import ObjectId, encode
 
 
 os.environ["TESTING"] = "TRUE"
 os.environ["MONGO_DB_NAME"] = "test"
-from fullstack import app, db, mongo_client
+from fullstack import app, db, mongo_client, passwords
+from fullstack.auth import principal_cache
+from fullstack.formats import decode_binary
+from fullstack.rollups import rebuild_rollups
+from fullstack.views import user as user_view
+import synthetic_data
 
 
 @pytest.fixture
 def client() -> FlaskClient:
     mongo_client.drop_database(os.getenv("MONGO_DB_NAME"))
+    principal_cache.clear()
     db.users.create_index('email', unique=True)
+    db.cache.create_index('patient', unique=True)
     client = app.test_client()
     yield client
 
@@ -29,7 +39,12 @@ def get_doctor(client: FlaskClient):
     patient = test_login(client, 'patient@example.com')
     doctor = test_login(client, 'doctor@example.com')
 
-    db.users.update_one({'_id': ObjectId(get_uid(client, doctor))}, {'$set': {'is_doctor': True, 'viewable': [ObjectId(get_uid(client, patient))]}})
+    doctor_id = ObjectId(get_uid(client, doctor))
+    db.users.update_one({'_id': doctor_id}, {'$set': {'is_doctor': True, 'viewable': [ObjectId(get_uid(client, patient))]}})
+    # Changed behind the API's back, so the cached principal has to be dropped by hand
+    principal_cache.invalidate(doctor_id)
+    # The role is part of the API key, so it takes a new one
+    doctor = client.post('/api/v1/user/login', json={'email': 'doctor@example.com', 'password': 'hello'}).json['api_key']
     return doctor, patient
 
 
@@ -70,6 +85,119 @@ def test_login(client: FlaskClient, email='test@example.com'):
     return out.json["api_key"]
 
 
+def test_rehash(client: FlaskClient, monkeypatch):
+    test_signup(client)
+    assert db.users.find_one({'email': 'test@example.com'})['password_hash'].startswith('$2b$12$')
+    app.config["BCRYPT_ROUNDS"] = 4
+    try:
+        def queue_full(password):
+            raise passwords.HashQueueFull()
+
+        # A full queue only puts off the rehash, the login itself succeeds
+        with monkeypatch.context() as m:
+            m.setattr(user_view, 'hash_password', queue_full)
+            assert client.post('/api/v1/user/login', json={'email': 'test@example.com', 'password': 'hello'}).status_code == 200
+        assert db.users.find_one({'email': 'test@example.com'})['password_hash'].startswith('$2b$12$')
+        assert client.post('/api/v1/user/login', json={'email': 'test@example.com', 'password': 'hello'}).status_code == 200
+        assert db.users.find_one({'email': 'test@example.com'})['password_hash'].startswith('$2b$04$')
+        assert client.post('/api/v1/user/login', json={'email': 'test@example.com', 'password': 'hello'}).status_code == 200
+        assert client.post('/api/v1/user/login', json={'email': 'test@example.com', 'password': 'nope'}).status_code == 401
+    finally:
+        app.config["BCRYPT_ROUNDS"] = 12
+    stats = passwords.stats()
+    assert stats['pending'] == 0 and stats['latency']['count'] >= 4
+
+
+def test_tokens(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    patient_id = get_uid(client, patient)
+    misses = principal_cache.stats()['misses']
+    assert client.get(f'/api/v1/user/{patient_id}', headers={'api_key': patient}).status_code == 200
+    # Patients are authenticated from the token alone
+    assert principal_cache.stats()['misses'] == misses
+
+    login = client.post('/api/v1/user/login', json={'email': 'patient@example.com', 'password': 'hello'}).json
+    assert login['expires_in'] == app.config["ACCESS_TOKEN_TTL"]
+    assert client.get('/api/v1/user', headers={'api_key': login['refresh_token']}).status_code == 400
+    out = client.post('/api/v1/user/refresh', json={'refresh_token': login['refresh_token']})
+    assert out.status_code == 200
+    assert client.get('/api/v1/user', headers={'api_key': out.json['api_key']}).status_code == 200
+    assert client.post('/api/v1/user/refresh', json={'refresh_token': login['api_key']}).status_code == 400
+
+    # Logging out revokes all tokens of the user
+    assert client.post('/api/v1/user/logout', headers={'api_key': patient}).status_code == 200
+    assert client.post('/api/v1/user/refresh', json={'refresh_token': login['refresh_token']}).status_code == 401
+    doctor_refresh = client.post('/api/v1/user/login', json={'email': 'doctor@example.com', 'password': 'hello'}).json
+    assert client.post('/api/v1/user/logout', headers={'api_key': doctor}).status_code == 200
+    assert client.get('/api/v1/user', headers={'api_key': doctor}).status_code == 401
+    assert client.get('/api/v1/user', headers={'api_key': doctor_refresh['api_key']}).status_code == 401
+
+    # Legacy API keys without claims still work until the user's tokens are revoked
+    legacy = jwt.encode({'id': patient_id, 'timestamp': int(time.time())}, key=app.config["SECRET_KEY"], algorithm="HS256")
+    assert client.get('/api/v1/user', headers={'api_key': legacy}).status_code == 401
+    db.users.update_one({'_id': ObjectId(patient_id)}, {'$unset': {'token_version': 1}})
+    principal_cache.clear()
+    assert client.get('/api/v1/user', headers={'api_key': legacy}).status_code == 200
+
+    expired = jwt.encode({'id': patient_id, 'typ': 'access', 'role': 'patient', 'tv': 0, 'exp': int(time.time()) - 1},
+                         key=app.config["SECRET_KEY"], algorithm="HS256")
+    assert client.get('/api/v1/user', headers={'api_key': expired}).status_code == 401
+
+
+def test_principal_cache(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    get_uid(client, doctor)
+    hits = principal_cache.stats()['hits']
+    get_uid(client, doctor)
+    assert principal_cache.stats()['hits'] == hits + 1
+
+    assert client.put('/api/v1/user/', json={'first_name': 'Dr.'}, headers={'api_key': doctor}).status_code == 200
+    misses = principal_cache.stats()['misses']
+    get_uid(client, doctor)
+    assert principal_cache.stats()['misses'] == misses + 1
+
+
+def test_metrics(client: FlaskClient, tmp_path):
+    doctor, patient = get_doctor(client)
+    client.get('/api/v1/data/previews', headers={'api_key': doctor})
+    assert client.get('/api/v1/metrics').status_code == 401
+    assert client.get('/api/v1/metrics', headers={'api_key': patient}).status_code == 403
+    out = client.get('/api/v1/metrics', headers={'api_key': doctor})
+    assert out.status_code == 200
+    spans = out.json['requests']['GET /api/v1/data/previews']
+    assert {'auth', 'compute', 'serialize', 'total'} <= set(spans)
+    assert spans['total']['count'] >= 1
+    assert sum(spans['total']['buckets'].values()) == spans['total']['count']
+    assert 'hits' in out.json['principal_cache']
+
+    app.config.update(PROFILE_SAMPLE_RATE=1, PROFILE_SLOW_MS=0, PROFILE_DIR=str(tmp_path))
+    try:
+        assert client.get('/api/v1/user', headers={'api_key': patient}).status_code == 200
+    finally:
+        app.config.update(PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_MS=500, PROFILE_DIR='profiles')
+    assert [path.suffix for path in tmp_path.iterdir()] == ['.prof']
+
+
+def test_viewable(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    doctor_id = get_uid(client, doctor)
+    patient_id = get_uid(client, patient)
+    assert client.get(f'/api/v1/user/{patient_id}', headers={'api_key': doctor}).status_code == 200
+    assert client.get(f'/api/v1/user/{doctor_id}', headers={'api_key': patient}).status_code == 403
+    assert client.get('/api/v1/user/nonsense', headers={'api_key': patient}).status_code == 400
+    out = client.get('/api/v1/user/', headers={'api_key': doctor})
+    assert [user['_id']['$oid'] for user in out.json['viewable']] == [patient_id]
+
+
+def test_extra(client: FlaskClient):
+    api_key = test_login(client)
+    assert client.put('/api/v1/data/extra', json={'weight': 80}, headers={'api_key': api_key}).status_code == 200
+    assert client.put('/api/v1/data/extra', json={'HbA1c': 48}, headers={'api_key': api_key}).status_code == 200
+    out = client.get(f'/api/v1/user/{get_uid(client, api_key)}', headers={'api_key': api_key})
+    assert out.json['extra_data']['weight'] == 80
+    assert out.json['extra_data']['HbA1c'] == 48
+
+
 def test_post_cgm(client: FlaskClient):
     api_key = test_login(client)
     out = client.post('/api/v1/data/', json={'type': 'cgm', 'timestamp': int(time.time()) - 300, 'value': 0.5}, headers={'api_key': api_key})
@@ -77,6 +205,30 @@ def test_post_cgm(client: FlaskClient):
     return api_key
 
 
+def test_post_batch(client: FlaskClient):
+    api_key = test_login(client)
+    now = int(time.time())
+    out = client.post('/api/v1/data/batch', json={'points': [{'type': 'cgm', 'timestamp': now - 900, 'value': 5.5},
+                                                             {'type': 'meals', 'timestamp': now - 900, 'value': 40},
+                                                             {'type': 'foo', 'timestamp': now, 'value': 1.0}],
+                                                  'cgm': {'t': [now - 600, now - 300], 'v': [6.0, 'x']}},
+                      headers={'api_key': api_key})
+    assert out.status_code == 200
+    assert out.json['inserted'] == 3
+    assert out.json['errors'] == [{'type': 'cgm', 'index': 1, 'error': 'Invalid value'},
+                                  {'index': 2, 'error': 'Invalid data type'}]
+
+    body = '{"type": "cgm", "timestamp": %d, "value": 7.0}\nfoo\n' % now
+    out = client.post('/api/v1/data/batch', data=body, content_type='application/x-ndjson', headers={'api_key': api_key})
+    assert out.status_code == 200
+    assert out.json['inserted'] == 1
+    assert out.json['errors'] == [{'index': 1, 'error': 'Invalid JSON'}]
+
+    out = client.post('/api/v1/data/get', json={'show': ['cgm', 'meals'], 'ndays': 1}, headers={'api_key': api_key})
+    assert len(out.json['cgm']) == 3
+    assert len(out.json['meals']) == 1
+
+
 def test_get_cgm(client: FlaskClient):
     api_key = test_post_cgm(client)
     out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'ndays': 1}, headers={'api_key': api_key})
@@ -85,6 +237,211 @@ def test_get_cgm(client: FlaskClient):
     assert len(out.json['cgm']) == 1
 
 
+def test_get_all_types(client: FlaskClient):
+    api_key = test_login(client)
+    now = int(time.time())
+    client.post('/api/v1/data/batch', json={col: {'t': [now - 600, now - 300], 'v': [1.0, 2.0]}
+                                            for col in ['basal', 'bolus', 'cgm', 'meals']}, headers={'api_key': api_key})
+    parallel = client.post('/api/v1/data/get', json={'ndays': 1}, headers={'api_key': api_key}).json
+    workers = app.config["DATA_FETCH_WORKERS"]
+    app.config["DATA_FETCH_WORKERS"] = 1
+    try:
+        sequential = client.post('/api/v1/data/get', json={'ndays': 1}, headers={'api_key': api_key}).json
+    finally:
+        app.config["DATA_FETCH_WORKERS"] = workers
+    assert parallel == sequential
+    assert sorted(parallel) == ['basal', 'bolus', 'cgm', 'exercise', 'meals']
+    assert len(parallel['meals']) == 2
+
+
+def test_get_cgm_stream(client: FlaskClient):
+    api_key = test_post_cgm(client)
+    out = client.post('/api/v1/data/get', json={'show': ['cgm', 'meals'], 'ndays': 1}, headers={'api_key': api_key})
+    streamed = client.post('/api/v1/data/get', json={'show': ['cgm', 'meals'], 'ndays': 1, 'stream': True},
+                           headers={'api_key': api_key})
+    assert streamed.status_code == 200
+    assert streamed.is_streamed
+    assert streamed.json == out.json
+
+
+def test_get_cgm_formats(client: FlaskClient):
+    api_key = test_login(client)
+    now = int(time.time())
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [now - 600, now - 300], 'v': [6.0, 7.5]}},
+                headers={'api_key': api_key})
+
+    out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'ndays': 1, 'format': 'columnar'},
+                      headers={'api_key': api_key})
+    assert out.json == {'cgm': {'t': [now - 600, 300], 'v': [6.0, 7.5]}}
+
+    out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'ndays': 1},
+                      headers={'api_key': api_key, 'Accept': 'application/octet-stream'})
+    assert out.mimetype == 'application/octet-stream'
+    timestamps, values = decode_binary(out.data)['cgm']
+    assert timestamps.tolist() == [now - 600, now - 300]
+    assert values.tolist() == [6.0, 7.5]
+
+
+def test_get_cgm_downsampled(client: FlaskClient):
+    api_key = test_login(client)
+    start = int(datetime.datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()) - 2 * 3600
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [start + 60, start + 1200, start + 3700], 'v': [4.0, 6.0, 9.0]}},
+                headers={'api_key': api_key})
+
+    out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'ndays': 1, 'resolution': 3600},
+                      headers={'api_key': api_key})
+    assert out.status_code == 200
+    assert out.json['cgm'] == [{'t': start, 'v': 5.0, 'min': 4.0, 'max': 6.0, 'n': 2},
+                               {'t': start + 3600, 'v': 9.0, 'min': 9.0, 'max': 9.0, 'n': 1}]
+
+    out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'ndays': 1, 'max_points': 1},
+                      headers={'api_key': api_key})
+    assert len(out.json['cgm']) <= 2
+    assert sum(bucket['n'] for bucket in out.json['cgm']) == 3
+
+
+def test_glycemic_metrics(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    patient_id = get_uid(client, patient)
+    now = int(time.time())
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [now - 900, now - 600, now - 300], 'v': [3.5, 6.0, 11.5]}},
+                headers={'api_key': patient})
+
+    out = client.post(f'/api/v1/data/{patient_id}/metrics', json={'ndays': 1}, headers={'api_key': doctor})
+    assert out.status_code == 200
+    assert out.json['readings'] == 3
+    assert out.json['mean'] == pytest.approx(7.0)
+    assert out.json['gmi'] == pytest.approx(6.327, abs=1e-3)
+    assert (out.json['tbr'], out.json['tir'], out.json['tar']) == pytest.approx((1 / 3, 1 / 3, 1 / 3))
+    assert len(out.json['agp']['50']) == 96
+
+    today = datetime.date.today().isoformat()
+    out = client.post('/api/v1/data/metrics', json={'start_time': today, 'end_time': today}, headers={'api_key': patient})
+    assert out.status_code == 200
+    out = client.post('/api/v1/data/metrics', json={'start_time': '2000-01-01', 'end_time': '2000-01-02'},
+                      headers={'api_key': patient})
+    assert out.json['readings'] == 0 and out.json['mean'] is None
+
+
+def test_rollups(client: FlaskClient):
+    api_key = test_login(client)
+    patient_id = ObjectId(get_uid(client, api_key))
+    day = datetime.datetime.combine(datetime.date.today(), datetime.time()) - datetime.timedelta(days=2)
+    start = int(day.timestamp())
+    next_day = int((day + datetime.timedelta(days=1)).timestamp())
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [start + 3600, start + 3900, start + 7300], 'v': [3.5, 6.0, 12.0]},
+                                            'bolus': {'t': [start + 3600, next_day + 3600], 'v': [4.0, 2.0]}},
+                headers={'api_key': api_key})
+    # Uploaded later, but in between the others
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [start + 4200], 'v': [8.0]}}, headers={'api_key': api_key})
+
+    out = client.post('/api/v1/data/rollups', json={'ndays': 3}, headers={'api_key': api_key})
+    assert out.status_code == 200
+    days = out.json['rollups']
+    assert [rollup['start'] for rollup in days] == [start, next_day]
+    assert days[0]['count'] == 4 and days[0]['min'] == 3.5 and days[0]['max'] == 12.0
+    assert days[0]['bolus'] == 4.0 and days[1]['bolus'] == 2.0
+    assert out.json['summary']['mean'] == pytest.approx((3.5 + 6.0 + 8.0 + 12.0) / 4)
+    assert out.json['summary']['bolus'] == 6.0
+
+    hours = client.post('/api/v1/data/rollups', json={'ndays': 3, 'period': 'hour'}, headers={'api_key': api_key}).json
+    assert [rollup['count'] for rollup in hours['rollups']] == [3, 1]
+    # The first reading has no previous one, and the last counts for at most 15 minutes
+    assert hours['rollups'][0]['band_time'] == {'2': 600.0}
+    assert hours['rollups'][1]['band_time'] == {'3': 900.0}
+
+    incremental = list(db.rollups.find({'patient': patient_id}, {'_id': 0}).sort([('period', 1), ('start', 1)]))
+    rebuild_rollups(patient_id)
+    rebuilt = list(db.rollups.find({'patient': patient_id}, {'_id': 0}).sort([('period', 1), ('start', 1)]))
+    assert [{k: v for k, v in r.items() if k != 'band_time'} for r in rebuilt] == \
+        [{k: v for k, v in r.items() if k != 'band_time'} for r in incremental]
+    assert client.post('/api/v1/data/rollups', json={'ndays': 3, 'period': 'x'}, headers={'api_key': api_key}).status_code == 400
+
+
+def test_cohort(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    other = test_login(client, 'other@example.com')
+    quiet = test_login(client, 'quiet@example.com')
+    ids = [ObjectId(get_uid(client, key)) for key in [patient, other, quiet]]
+    doctor_id = ObjectId(get_uid(client, doctor))
+    db.users.update_one({'_id': doctor_id}, {'$set': {'viewable': ids}})
+    principal_cache.invalidate(doctor_id)
+
+    now = int(time.time())
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [now - 900, now - 600, now - 300], 'v': [3.5, 6.0, 3.0]}},
+                headers={'api_key': patient})
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [now - 900, now - 600], 'v': [7.0, 12.0]}},
+                headers={'api_key': other})
+
+    out = client.post('/api/v1/data/cohort', json={'ndays': 1}, headers={'api_key': doctor})
+    assert out.status_code == 200
+    assert out.json['total'] == 3
+    assert [row['_id']['$oid'] for row in out.json['patients']] == [str(i) for i in ids]
+    assert out.json['patients'][0]['hypos'] == 2
+    assert out.json['patients'][0]['tbr'] == pytest.approx(2 / 3)
+    assert out.json['patients'][2]['readings'] == 0 and out.json['patients'][2]['tbr'] is None
+
+    out = client.post('/api/v1/data/cohort', json={'ndays': 1, 'sort': 'mean', 'order': 'asc', 'offset': 1, 'limit': 1},
+                      headers={'api_key': doctor})
+    assert [row['mean'] for row in out.json['patients']] == [pytest.approx(9.5)]
+    assert client.post('/api/v1/data/cohort', json={'ndays': 1, 'sort': 'x'}, headers={'api_key': doctor}).status_code == 400
+    assert client.post('/api/v1/data/cohort', json={'ndays': 1}, headers={'api_key': patient}).status_code == 403
+
+
+def test_previews(client: FlaskClient):
+    api_key = test_post_cgm(client)
+    out = client.get('/api/v1/data/previews', headers={'api_key': api_key})
+    assert out.status_code == 200
+    assert len(out.json) == 1
+    assert len(out.json[0]['values']) == 96
+    assert out.json[0]['distribution'][0] == 1.0
+    assert out.json[0]['problems'] == [0, 1, 2]
+
+
+def test_preview_engine_fallback(client: FlaskClient):
+    # mongomock can't run the pipeline, so the aggregate engine falls back to numpy here; the pipeline itself is
+    # checked in test_pipelines against a real MongoDB
+    api_key = test_post_cgm(client)
+    app.config["PREVIEW_ENGINE"] = "python"
+    python_out = client.get('/api/v1/data/previews', headers={'api_key': api_key}).json
+    db.cache.delete_many({})
+    app.config["PREVIEW_ENGINE"] = "aggregate"
+    aggregate_out = client.get('/api/v1/data/previews', headers={'api_key': api_key}).json
+    for key in ['values', 'distribution', 'problems']:
+        assert python_out[0][key] == aggregate_out[0][key]
+
+
+def test_previews_settings(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    patient_id = get_uid(client, patient)
+    client.post('/api/v1/data/', json={'type': 'cgm', 'timestamp': int(time.time()) - 300, 'value': 3.5},
+                headers={'api_key': patient})
+    out = client.get('/api/v1/data/previews', headers={'api_key': doctor})
+    assert out.json[0]['distribution'][1] == 1.0
+
+    out = client.put(f"/api/v1/user/glycemic/{patient_id}", json={'glycemic_ranges': [3.0, 3.4, 10.0, 13.9]},
+                     headers={'api_key': doctor})
+    assert out.status_code == 200
+    out = client.get('/api/v1/data/previews', headers={'api_key': doctor})
+    assert out.json[0]['distribution'][2] == 1.0
+    assert db.cache.count_documents({'patient': ObjectId(patient_id)}) == 1
+    version = db.users.find_one({'_id': ObjectId(patient_id)})['settings_version']
+
+    # Only new ranges make the previews get rebuilt
+    for settings in [{'glycemic_targets': [0.1, 0.1, 0.5, 0.2, 0.1]}, {'glycemic_ranges': [3.0, 3.4, 10.0, 13.9]}]:
+        out = client.put(f"/api/v1/user/glycemic/{patient_id}", json=settings, headers={'api_key': doctor})
+        assert out.status_code == 200
+    assert db.users.find_one({'_id': ObjectId(patient_id)})['settings_version'] == version
+
+    # A viewable id without a user
+    missing = ObjectId()
+    db.users.update_one({'email': 'doctor@example.com'}, {'$push': {'viewable': missing}})
+    principal_cache.clear()
+    for settings in [{'glycemic_ranges': [3.0, 3.4, 10.0, 13.9]}, {'glycemic_targets': [0.1, 0.1, 0.5, 0.2, 0.1]}]:
+        out = client.put(f"/api/v1/user/glycemic/{missing}", json=settings, headers={'api_key': doctor})
+        assert out.status_code == 404
+
+
 def test_note(client: FlaskClient):
     api_key = test_login(client)
     out = client.post("/api/v1/note", json={'text': 'foo'}, headers={'api_key': api_key})
@@ -133,3 +490,108 @@ def test_diagnosis(client: FlaskClient):
 
     out = client.get(f"/api/v1/diagnosis", headers={'api_key': patient})
     assert len(out.json) == 0
+
+
+def test_note_pages(client: FlaskClient):
+    api_key = test_login(client)
+    patient_id = ObjectId(get_uid(client, api_key))
+    now = datetime.datetime.now().replace(microsecond=0)
+    # Notes at the same time are still paged in order, by id
+    times = [now - datetime.timedelta(hours=1)] * 3 + [now] * 2
+    db.note.insert_many([{'text': str(i), 'timestamp': t, 'patient': patient_id, 'writer': patient_id}
+                         for i, t in enumerate(times)])
+
+    texts = []
+    out = client.get("/api/v1/note?limit=2", headers={'api_key': api_key})
+    while 'X-Next-Cursor' in out.headers:
+        assert len(out.json) == 2
+        texts += [note['text'] for note in out.json]
+        out = client.get(f"/api/v1/note?limit=2&cursor={out.headers['X-Next-Cursor']}", headers={'api_key': api_key})
+    texts += [note['text'] for note in out.json]
+    assert texts == ['0', '1', '2', '3', '4']
+
+    since = (now - datetime.timedelta(minutes=1)).timestamp()
+    out = client.get(f"/api/v1/note?since={since}&fields=text", headers={'api_key': api_key})
+    assert [set(note) for note in out.json] == [{'_id', 'text'}] * 2
+    assert 'X-Next-Cursor' not in out.headers
+
+    not_a_list = urlsafe_b64encode(encode({'k': 5})).decode()
+    for query in ['limit=0', 'limit=1001', 'cursor=foo', f'cursor={not_a_list}', 'fields=patient', 'since=foo']:
+        out = client.get(f"/api/v1/note?{query}", headers={'api_key': api_key})
+        assert out.status_code == 400
+
+
+def test_diagnosis_pages(client: FlaskClient):
+    doctor, patient = get_doctor(client)
+    patient_id = get_uid(client, patient)
+    for i in range(3):
+        client.post(f"/api/v1/diagnosis/{patient_id}", json={'name': str(i), 'medicine': []}, headers={'api_key': doctor})
+
+    out = client.get("/api/v1/diagnosis?limit=2&fields=name", headers={'api_key': patient})
+    assert [diag['name'] for diag in out.json] == ['0', '1']
+    assert set(out.json[0]) == {'_id', 'name'}
+    out = client.get(f"/api/v1/diagnosis?cursor={out.headers['X-Next-Cursor']}", headers={'api_key': patient})
+    assert [diag['name'] for diag in out.json] == ['2']
+    assert 'timestamp' in out.json[0]
+
+    out = client.get(f"/api/v1/diagnosis?since={time.time() + 60}", headers={'api_key': patient})
+    assert out.json == []
+
+
+def test_sync_data(client: FlaskClient):
+    api_key = test_login(client)
+    now = int(time.time())
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [now - 600, now - 300], 'v': [5.0, 6.0]}},
+                headers={'api_key': api_key})
+    out = client.post('/api/v1/data/get', json={'show': ['cgm', 'meals'], 'ndays': 1, 'since': {}},
+                      headers={'api_key': api_key})
+    assert len(out.json['data']['cgm']) == 2
+    assert out.json['data']['meals'] == []
+    since = out.json['since']
+    assert since['cgm'] == now - 300
+    assert since['meals'] is None
+
+    client.post('/api/v1/data/batch', json={'cgm': {'t': [now], 'v': [7.0]}, 'meals': {'t': [now - 900], 'v': [40]}},
+                headers={'api_key': api_key})
+    # Without a window, only data types with a mark can be synced
+    out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'since': since}, headers={'api_key': api_key})
+    assert out.json['data']['cgm'] == [{'t': now, 'v': 7.0}]
+    assert out.json['since']['cgm'] == now
+    out = client.post('/api/v1/data/get', json={'show': ['cgm', 'meals'], 'since': since}, headers={'api_key': api_key})
+    assert out.status_code == 400
+
+    for mark in ['x', 1e20, float('nan')]:
+        out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'since': {'cgm': mark}}, headers={'api_key': api_key})
+        assert out.status_code == 400
+    out = client.post('/api/v1/data/get', json={'show': ['cgm'], 'since': since, 'format': 'columnar'},
+                      headers={'api_key': api_key})
+    assert out.status_code == 400
+
+
+def test_get_synthetic_exercise(client: FlaskClient):
+    synthetic_data.seed(db, 4, 3)
+    # Exercise is stored with a duration and intensity rather than a value
+    exercise = db.exercise.find_one()
+    assert 'value' not in exercise
+    email = db.users.find_one({'_id': exercise['patient']})['email']
+    out = client.post('/api/v1/user/login', json={'email': email, 'password': 'password1'})
+    api_key = out.json['api_key']
+
+    out = client.post('/api/v1/data/get', json={'ndays': 4}, headers={'api_key': api_key})
+    assert out.status_code == 200
+    exercise = out.json['exercise']
+    assert exercise and all(0 < e['v'] < 1 and e['d'] > 0 for e in exercise)
+    out = client.post('/api/v1/data/get', json={'ndays': 4, 'stream': True}, headers={'api_key': api_key})
+    assert out.json['exercise'] == exercise
+    out = client.post('/api/v1/data/get', json={'ndays': 4, 'since': {}}, headers={'api_key': api_key})
+    assert out.json['data']['exercise'] == exercise
+    out = client.post('/api/v1/data/get', json={'ndays': 4, 'resolution': 3600}, headers={'api_key': api_key})
+    assert out.status_code == 200
+
+    # The durations are in every format
+    out = client.post('/api/v1/data/get', json={'ndays': 4, 'format': 'columnar'}, headers={'api_key': api_key})
+    assert out.json['exercise']['d'] == [e['d'] for e in exercise]
+    out = client.post('/api/v1/data/get', json={'ndays': 4, 'format': 'binary'}, headers={'api_key': api_key})
+    series = decode_binary(out.data)
+    assert series['exercise.d'][0].tolist() == series['exercise'][0].tolist() == [e['t'] for e in exercise]
+    assert series['exercise.d'][1].tolist() == pytest.approx([e['d'] for e in exercise])
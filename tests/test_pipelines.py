@@ -0,0 +1,74 @@
+import datetime
+import os
+
+import numpy as np
+import pytest
+from bson import ObjectId
+from pymongo import MongoClient
+
+
+os.environ["TESTING"] = "TRUE"
+os.environ["MONGO_DB_NAME"] = "test"
+from fullstack import cohort, previews, series
+
+# mongomock doesn't implement $setWindowFields, so the pipelines can only be checked against a real MongoDB 5.0+
+MONGO_TEST_URI = os.getenv("MONGO_TEST_URI")
+pytestmark = pytest.mark.skipif(not MONGO_TEST_URI, reason="Set MONGO_TEST_URI to a MongoDB server to run")
+
+
+@pytest.fixture
+def real_db(monkeypatch):
+    client = MongoClient(MONGO_TEST_URI)
+    database = client['pipeline_test']
+    client.drop_database(database.name)
+    for module in [cohort, previews, series]:
+        monkeypatch.setattr(module, 'db', database)
+    yield database
+    client.drop_database(database.name)
+    client.close()
+
+
+def add_readings(database, patients: int, days: int) -> list:
+    rng = np.random.default_rng(0)
+    ids = [ObjectId() for _ in range(patients)]
+    begin = datetime.datetime.now().replace(second=0, microsecond=0) - datetime.timedelta(days=days)
+    docs = []
+    for patient_id in ids:
+        # Irregular intervals and a wide spread of values, so every band and many hypos show up
+        minutes = np.cumsum(rng.integers(1, 15, days * 24 * 12))
+        minutes = minutes[minutes < days * 24 * 60]
+        values = np.round(np.clip(7 + 4 * np.sin(minutes / 180) + rng.normal(0, 2, len(minutes)), 2.2, 22.2), 1)
+        docs += [{'patient': patient_id, 'timestamp': begin + datetime.timedelta(minutes=int(m)), 'value': float(v)}
+                 for m, v in zip(minutes, values)]
+    database.cgm.insert_many(docs)
+    return ids
+
+
+def test_preview_pipeline(real_db):
+    ids = add_readings(real_db, 3, 2)
+    patients = [{'_id': ids[0]}, {'_id': ids[1], 'glycemic_ranges': [3.0, 3.5, 9.0, 13.0]}, {'_id': ids[2]},
+                {'_id': ObjectId()}]
+    start_time = datetime.datetime.now() - datetime.timedelta(days=1, hours=12)
+    aggregated = previews._aggregate(patients, start_time)
+    accumulated = previews._accumulate(patients, start_time)
+
+    assert set(aggregated) == set(accumulated) == set(ids)
+    for patient_id in ids:
+        np.testing.assert_allclose(aggregated[patient_id]['sums'], accumulated[patient_id]['sums'])
+        np.testing.assert_array_equal(aggregated[patient_id]['counts'], accumulated[patient_id]['counts'])
+        np.testing.assert_allclose(aggregated[patient_id]['band_time'], accumulated[patient_id]['band_time'])
+        assert aggregated[patient_id]['end'] == accumulated[patient_id]['end']
+
+
+def test_cohort_pipeline(real_db):
+    ids = add_readings(real_db, 3, 2) + [ObjectId()]
+    start_time = datetime.datetime.now() - datetime.timedelta(days=1, hours=12)
+    end_time = datetime.datetime.now() - datetime.timedelta(hours=6)
+    aggregated = cohort._aggregate(ids, start_time, end_time)
+    accumulated = cohort._accumulate(ids, start_time, end_time)
+
+    assert accumulated['hypos'].sum() > 0
+    for key in ['readings', 'bands', 'hypos']:
+        np.testing.assert_array_equal(aggregated[key], accumulated[key])
+    for key in ['sum', 'sumsq']:
+        np.testing.assert_allclose(aggregated[key], accumulated[key])
@@ -0,0 +1,97 @@
+import datetime
+import os
+
+import pytest
+from bson import ObjectId
+
+os.environ["TESTING"] = "TRUE"
+os.environ["MONGO_DB_NAME"] = "test"
+from fullstack import db, mongo_client
+from fullstack import previews
+from fullstack.previews import load_previews, record_readings, _build_states
+from fullstack.worker import run_once
+
+
+@pytest.fixture
+def patient() -> dict:
+    mongo_client.drop_database(os.getenv("MONGO_DB_NAME"))
+    patient = {'_id': ObjectId()}
+    now = datetime.datetime.now().replace(microsecond=0)
+    db.cgm.insert_many([{'patient': patient['_id'], 'timestamp': now - datetime.timedelta(minutes=37 * i),
+                         'value': 2.0 + (i % 13)} for i in range(1, 800)])
+    yield patient
+
+
+def assert_same(a: dict, b: dict):
+    assert a['values'] == pytest.approx(b['values'])
+    assert a['distribution'] == pytest.approx(b['distribution'], abs=1e-6)
+    assert a['problems'] == b['problems']
+
+
+def test_incremental(patient):
+    load_previews([patient])
+    now = datetime.datetime.now().replace(microsecond=0)
+    timestamps = [now + datetime.timedelta(minutes=5), now + datetime.timedelta(minutes=10)]
+    db.cgm.insert_many([{'patient': patient['_id'], 'timestamp': t, 'value': 15.0} for t in timestamps])
+    record_readings(patient['_id'], timestamps, [15.0, 15.0])
+    incremental = load_previews([patient])[0]
+
+    db.cache.delete_many({})
+    assert_same(incremental, load_previews([patient])[0])
+
+
+def test_out_of_order(patient):
+    load_previews([patient])
+    timestamp = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=1)
+    db.cgm.insert_one({'patient': patient['_id'], 'timestamp': timestamp, 'value': 15.0})
+    record_readings(patient['_id'], [timestamp], [15.0])
+    assert db.cache.find_one({'patient': patient['_id']}) is None
+
+
+def test_already_built(patient):
+    # The state is built from the database after a reading is stored but before it is recorded
+    timestamp = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(minutes=5)
+    db.cgm.insert_one({'patient': patient['_id'], 'timestamp': timestamp, 'value': 15.0})
+    load_previews([patient])
+    record_readings(patient['_id'], [timestamp], [15.0])
+    assert db.cache.find_one({'patient': patient['_id']}) is None
+
+
+def test_recorded_while_building(patient, monkeypatch):
+    timestamp = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(minutes=5)
+    accumulate_previews = previews.accumulate_previews
+
+    def upload_during_build(patients, start_time):
+        # The readings are read before the upload is stored and recorded
+        accumulated = accumulate_previews(patients, start_time)
+        db.cgm.insert_one({'patient': patient['_id'], 'timestamp': timestamp, 'value': 20.0})
+        record_readings(patient['_id'], [timestamp], [20.0])
+        return accumulated
+
+    monkeypatch.setattr(previews, 'accumulate_previews', upload_during_build)
+    load_previews([patient])
+    monkeypatch.undo()
+    later = timestamp + datetime.timedelta(minutes=5)
+    db.cgm.insert_one({'patient': patient['_id'], 'timestamp': later, 'value': 20.0})
+    record_readings(patient['_id'], [later], [20.0])
+    incremental = load_previews([patient])[0]
+
+    db.cache.delete_many({})
+    assert_same(incremental, load_previews([patient])[0])
+
+
+def test_trim(patient):
+    _build_states([patient], datetime.datetime.now() - datetime.timedelta(days=14, hours=9))
+    trimmed = load_previews([patient])[0]
+    assert db.cache.find_one({'patient': patient['_id']})['start'] > datetime.datetime.now() - datetime.timedelta(days=14, hours=1)
+
+    db.cache.delete_many({})
+    assert_same(trimmed, load_previews([patient])[0])
+
+
+def test_worker(patient):
+    db.users.insert_many([{'_id': patient['_id']}, {'is_doctor': True}, {}])
+    assert run_once(None, 2) == 2
+    assert db.cache.count_documents({}) == 2
+    state = db.cache.find_one({'patient': patient['_id']})
+    assert load_previews([patient])[0]['_id'] == state['_id']
@@ -0,0 +1,28 @@
+import datetime
+import json
+import os
+
+import pytest
+from bson import ObjectId, json_util
+
+os.environ["TESTING"] = "TRUE"
+os.environ["MONGO_DB_NAME"] = "test"
+from fullstack.serializers import SERIALIZERS, serialize
+
+
+PAYLOAD = {'_id': ObjectId(), 'timestamp': datetime.datetime(2022, 6, 8, 16, 21, 42, 600000),
+           'values': [1.5, None, 3], 'nested': [{'name': 'diagnosis1', 'medicine': ['medicine1']}]}
+
+
+@pytest.mark.parametrize('name', SERIALIZERS.keys())
+def test_same_output(name):
+    assert json.loads(serialize(PAYLOAD, name)) == json.loads(json_util.dumps(PAYLOAD))
+
+
+@pytest.mark.parametrize('name', SERIALIZERS.keys())
+def test_iterable(name):
+    assert json.loads(serialize(iter([PAYLOAD]), name)) == json.loads(json_util.dumps([PAYLOAD]))
+
+
+def test_fallback():
+    assert json.loads(serialize({'big': 2 ** 70})) == {'big': 2 ** 70}
@@ -0,0 +1,30 @@
+import mongomock
+import numpy as np
+
+import synthetic_data
+
+
+def test_simulate():
+    data = synthetic_data.simulate(20, 7, np.random.default_rng(0))
+    cgm = data['cgm']
+    assert cgm.shape == (20, 7 * synthetic_data.SAMPLES_PER_DAY)
+    values = cgm[~np.isnan(cgm)]
+    assert 0.9 < len(values) / cgm.size < 1
+    assert values.min() >= 2.2 and values.max() <= 22.2
+    assert 6 < values.mean() < 11
+    assert 0.5 < ((values >= 3.9) & (values <= 10)).mean() < 0.95
+    assert 2 < np.count_nonzero(data['meals']) / 20 / 7 < 6
+    assert data['basal'].shape == (20, 7 * 24)
+    assert (data['exercise'][1] >= 0).all()
+
+
+def test_seed():
+    db = mongomock.MongoClient()['synthetic']
+    users = synthetic_data.seed(db, 6, 2, doctors=3, panel_size=4, chunk_size=4)
+    assert len(users['patients']) == 6
+    doctors = list(db.users.find({'is_doctor': True}))
+    assert [doctor['email'] for doctor in doctors] == ['Doctor@example.com', 'Doctor1@example.com', 'Doctor2@example.com']
+    assert all(len(set(doctor['viewable'])) == 4 for doctor in doctors)
+    assert len(db.cgm.distinct('patient')) == 6
+    assert db.cgm.count_documents({}) > 6 * 2 * synthetic_data.SAMPLES_PER_DAY * 0.9
+